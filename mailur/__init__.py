@@ -20,6 +20,18 @@ conf = {
     'USER': os.environ.get('MLR_USER'),
     'DOMAIN': os.environ.get('MLR_DOMAIN', 'localhost'),
     'USE_PROXY': os.environ.get('MLR_USE_PROXY', False),
+    'IMAP_POOL_SIZE': int(os.environ.get('MLR_IMAP_POOL_SIZE', 10)),
+    'IMAP_POOL_USERS': int(os.environ.get('MLR_IMAP_POOL_USERS', 100)),
+    'IMAP_POOL_TIMEOUT': int(os.environ.get('MLR_IMAP_POOL_TIMEOUT', 300)),
+    # COMPRESS=DEFLATE for "local" and/or "remote" connections
+    'IMAP_COMPRESS': os.environ.get('MLR_IMAP_COMPRESS', 'remote').split(),
+    # metadata deltas saved before the next full snapshot
+    'METADATA_JOURNAL': int(os.environ.get('MLR_METADATA_JOURNAL', 100)),
+    # directory for SQLite index of metadata, "mlr/Sys" is used if empty
+    'METADATA_DB': os.environ.get('MLR_METADATA_DB', ''),
+    # in-process cache: budget in bytes for all users and TTL in seconds
+    'CACHE_SIZE': int(os.environ.get('MLR_CACHE_SIZE', 512 * 2**20)),
+    'CACHE_TTL': int(os.environ.get('MLR_CACHE_TTL', 3600)),
 }
 
 
@@ -1,29 +1,107 @@
-from . import conf
+import builtins
+import itertools as it
+import sys
+import time
+from collections import OrderedDict
 
-store = {}
+from . import conf, log
+
+# (user, name) -> (value, size, expires), the least recently used first
+store = OrderedDict()
+stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'size': 0}
 
 
 def key(name):
     return conf['USER'], name
 
 
+# items measured to estimate the size of a container
+SAMPLE = 10
+
+
+def sizeof(value):
+    """Rough size of the value in bytes.
+
+    Containers (subclasses too) are counted by the average size of a few
+    of their items, so it's cheap even for big metadata.
+    """
+    def measure(obj):
+        size = sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            items = list(it.islice(obj.items(), SAMPLE))
+            sample = sum(measure(k) + measure(v) for k, v in items)
+        elif isinstance(obj, (list, tuple, builtins.set, frozenset)):
+            items = list(it.islice(obj, SAMPLE))
+            sample = sum(measure(i) for i in items)
+        else:
+            return size
+        if items:
+            size += sample * len(obj) // len(items)
+        return size
+
+    return measure(value)
+
+
 def get(name, default=None):
-    return store.get(key(name), default)
+    k = key(name)
+    item = store.get(k)
+    if item is None:
+        stats['misses'] += 1
+        return default
+
+    value, size, expires = item
+    if expires and expires < time.time():
+        pop(k)
+        stats['misses'] += 1
+        return default
 
+    store.move_to_end(k)
+    stats['hits'] += 1
+    return value
 
-def set(name, value):
-    store[key(name)] = value
+
+def set(name, value, ttl=None, size=None):
+    k = key(name)
+    pop(k)
+    if size is None:
+        size = sizeof(value)
+    ttl = conf['CACHE_TTL'] if ttl is None else ttl
+    store[k] = value, size, ttl and time.time() + ttl
+    stats['size'] += size
+    evict()
+
+
+def pop(k):
+    item = store.pop(k, None)
+    if item is not None:
+        stats['size'] -= item[1]
+    return item
+
+
+def evict():
+    """Drop the least recently used entries of any user over the budget."""
+    limit = conf['CACHE_SIZE']
+    while limit and stats['size'] > limit and len(store) > 1:
+        k, _ = next(iter(store.items()))
+        pop(k)
+        stats['evictions'] += 1
+        log.debug('cache: evicted %r', k)
 
 
 def rm(name):
-    store.pop(key(name), None)
+    pop(key(name))
 
 
 def clear():
-    for key in list(store.keys()):
-        if key[0] == conf['USER']:
-            del store[key]
+    for k in list(store.keys()):
+        if k[0] == conf['USER']:
+            pop(k)
 
 
 def exists(name):
-    return key(name) in store
+    item = store.get(key(name))
+    return item is not None and not (item[2] and item[2] < time.time())
+
+
+def info():
+    return dict(stats, entries=len(store))
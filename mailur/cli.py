@@ -5,6 +5,7 @@ Usage:
   mlr remote <login> [--tag=<tag> --box=<box> --parse] [options]
   mlr parse <login> [<criteria>] [options]
   mlr metadata <login> [<uids>]
+  mlr metadata <login> --rebuild
   mlr sync <login> [--timeout=<timeout>]
   mlr sync-flags <login> [--reverse]
   mlr clean-flags <login> <flag>...
@@ -74,6 +75,8 @@ def process(args):
             local.sync_flags_to_all()
     elif args['clean-flags']:
         local.clean_flags(args['<flag>'])
+    elif args['metadata'] and args['--rebuild']:
+        local.rebuild_metadata()
     elif args['metadata']:
         local.update_metadata(args.get('<uids>'))
     elif args['icons']:
@@ -1,19 +1,24 @@
+import bisect
 import functools as ft
 import inspect
+import io
+import itertools as it
 import json
 import re
 import time
+import zlib
+from array import array
+from collections import OrderedDict
 from contextlib import contextmanager
-from imaplib import CRLF, Time2Internaldate
+from imaplib import CRLF, IMAP4, Time2Internaldate
 
-from gevent import Timeout
+from gevent import Timeout, getcurrent
 from gevent.lock import RLock
 from gevent.pool import Pool
 
 from . import conf, fn_desc, fn_time, log
 
 commands = {}
-pool = {}
 
 
 class Error(Exception):
@@ -21,7 +26,144 @@ class Error(Exception):
         return '%s.%s: %s' % (__name__, self.__class__.__name__, self.args)
 
 
-def using(client, box, readonly=True, name='con', reuse=True, parent=False):
+# after these connections could be in inconsistent state
+errors = (Error, IMAP4.error)
+
+
+class ConnPool:
+    """Long-lived connections keyed by (user, client, box).
+
+    Idle connections are closed after "timeout" seconds, connections idle
+    more than "check" seconds are verified with NOOP before reuse. Each user
+    keeps at most "size" connections and only "users" most recently active
+    users are kept, others are evicted. Connections in use are never closed,
+    replaced ones are closed when the key isn't used anymore.
+    """
+    def __init__(self, *, size=10, users=100, timeout=300, check=30):
+        self.size = size
+        self.users = users
+        self.timeout = timeout
+        self.check = check
+        self.items = OrderedDict()
+        self.locks = {}
+        self.busy = {}
+        self.retired = {}
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def keys(self):
+        return list(self.items.keys())
+
+    def get(self, key, create):
+        self.expire()
+        # only one connection is created for concurrent misses of the key
+        with self.locks.setdefault(key, RLock()):
+            con = None
+            item = self.items.pop(key, None)
+            if item:
+                con, used = item
+                if not self.is_alive(con, used):
+                    con = None
+            if con is None:
+                con = create()
+            self.items[key] = con, time.time()
+        self.evict(key)
+        return con
+
+    @contextmanager
+    def use(self, key, create):
+        """Connection from "get" which isn't closed until the end."""
+        self.busy[key] = self.busy.get(key, 0) + 1
+        try:
+            yield self.get(key, create)
+        finally:
+            self.busy[key] -= 1
+            if not self.busy[key]:
+                del self.busy[key]
+                for old in self.retired.pop(key, []):
+                    old.logout()
+
+    def set(self, key, con):
+        old = self.items.pop(key, None)
+        if old and old[0] is not con:
+            if key in self.busy:
+                # other greenlets could still use the old connection
+                self.retired.setdefault(key, []).append(old[0])
+            else:
+                old[0].logout()
+        self.items[key] = con, time.time()
+
+    def pop(self, key, default=None):
+        item = self.items.pop(key, None)
+        return item[0] if item else default
+
+    def close(self, key):
+        con = self.pop(key)
+        if con:
+            con.logout()
+
+    def is_alive(self, con, used):
+        if time.time() - used < self.check:
+            return True
+        try:
+            con.noop()
+            return True
+        except Error as e:
+            log.info('%s is expired: %r', con, e)
+            con.logout()
+            return False
+
+    def expire(self):
+        now = time.time()
+        for key, (con, used) in list(self.items.items()):
+            if now - used > self.timeout and key not in self.busy:
+                self.close(key)
+
+    def evict(self, key):
+        def idle(keys):
+            return [k for k in keys if k != key and k not in self.busy]
+
+        keys = [k for k in self.items if k[0] == key[0]]
+        for k in idle(keys[:-self.size or None]):
+            self.close(k)
+
+        users = []
+        for k in reversed(self.items):
+            if k[0] not in users:
+                users.append(k[0])
+        for k in idle(k for k in self.items if k[0] in users[self.users:]):
+            self.close(k)
+
+    def release(self, user):
+        # next select of the same mailbox should sync it with the server
+        for key, (con, used) in self.items.items():
+            if key[0] == user:
+                con.synced = False
+
+    def clean(self, user):
+        for key in self.keys():
+            if key[0] != user:
+                continue
+            self.locks.pop(key, None)
+            self.close(key)
+        for key in list(self.retired):
+            if key[0] == user and key not in self.busy:
+                for con in self.retired.pop(key):
+                    con.logout()
+
+
+pool = ConnPool(
+    size=conf['IMAP_POOL_SIZE'],
+    users=conf['IMAP_POOL_USERS'],
+    timeout=conf['IMAP_POOL_TIMEOUT'],
+)
+
+
+def using(
+    client, box, readonly=True, name='con', reuse=True, parent=False,
+    fresh=False
+):
     @contextmanager
     def use_or_create(kw):
         if kw.get(name):
@@ -30,28 +172,28 @@ def using(client, box, readonly=True, name='con', reuse=True, parent=False):
 
         if reuse:
             key = conf['USER'], client, box
-            if key not in pool:
-                pool[key] = client(None)
-            con = pool[key]
-            parent_orig = con.parent
-            if not con.parent and box:
+            with pool.use(key, ft.partial(client, None)) as con:
+                parent_orig = con.parent
+                if not con.parent and box:
+                    try:
+                        con.select(box, readonly, fresh=fresh or parent)
+                    except (con.abort, Error) as e:
+                        # probably connection is already expired
+                        # try to create new one
+                        log.error(e)
+                        con = client(None)
+                        pool.set(key, con)
+                        con.parent = parent_orig
+                        con.select(box, readonly)
+                    if parent:
+                        con.parent = parent
+                if name:
+                    kw[name] = con
                 try:
-                    con.select(box, readonly)
-                except con.abort as e:
-                    # probably connection is already expired
-                    # try to create new one
-                    log.error(e)
-                    pool[key] = client(None)
-                    con = pool[key]
-                    con.parent = parent_orig
-                    con.select(box, readonly)
-                if parent:
-                    con.parent = parent
-            if name:
-                kw[name] = con
-            yield
-            if con.parent:
-                con.parent = parent_orig
+                    yield
+                finally:
+                    if con.parent:
+                        con.parent = parent_orig
             return
 
         with client(box, readonly=readonly) as con:
@@ -77,13 +219,7 @@ def using(client, box, readonly=True, name='con', reuse=True, parent=False):
 def clean_pool(user=None):
     if user is None:
         user = conf['USER']
-
-    for key in list(pool.keys()):
-        if key[0] != user:
-            continue
-        con = pool.pop(key, None)
-        if con:
-            con.logout()
+    pool.clean(user)
 
 
 def cmd_locked(func):
@@ -103,14 +239,43 @@ def cmd_writable(func):
     return inner
 
 
+def cmd_guard(func):
+    """Other commands can't be sent while "fetch_iter" isn't drained.
+
+    Other greenlets wait for the lock, but the same greenlet would get it
+    and read responses of "fetch_iter" as its own.
+    """
+    def check(con):
+        if con.streaming is not None and con.streaming is getcurrent():
+            raise Error('%s: "fetch_iter" is not drained' % con)
+
+    def inner_fn(con, *a, **kw):
+        check(con)
+        return func(con, *a, **kw)
+
+    def inner_gen(con, *a, **kw):
+        check(con)
+        yield from func(con, *a, **kw)
+
+    inner = inner_gen if inspect.isgeneratorfunction(func) else inner_fn
+    return ft.wraps(func)(inner)
+
+
 def cmd_error(func):
-    @ft.wraps(func)
-    def inner(con, *a, **kw):
+    def inner_fn(con, *a, **kw):
         try:
             return func(con, *a, **kw)
         except con.error as e:
             raise Error(e)
-    return inner
+
+    def inner_gen(con, *a, **kw):
+        try:
+            yield from func(con, *a, **kw)
+        except con.error as e:
+            raise Error(e)
+
+    inner = inner_gen if inspect.isgeneratorfunction(func) else inner_fn
+    return ft.wraps(func)(inner)
 
 
 def check(res):
@@ -120,7 +285,9 @@ def check(res):
     return data
 
 
-def command(*, name=None, lock=True, writable=False, dovecot=False):
+def command(
+    *, name=None, lock=True, writable=False, dovecot=False, guard=True
+):
     def inner(func):
         if name:
             func.name = name
@@ -129,6 +296,8 @@ def command(*, name=None, lock=True, writable=False, dovecot=False):
 
         if lock:
             func = cmd_locked(func)
+        if guard:
+            func = cmd_guard(func)
 
         func = cmd_error(func)
         commands[func] = {'writable': writable, 'dovecot': dovecot}
@@ -140,6 +309,14 @@ class Conn:
     def defaults(self):
         self.current_box = None
         self.flags = None
+        self.uidnext = None
+        self.uidvalidity = None
+        self.exists = None
+        self.highestmodseq = None
+        self.enabled = set()
+        self.synced = False
+        # greenlet which reads responses of "fetch_iter"
+        self.streaming = None
 
     def __repr__(self):
         return str(self)
@@ -193,6 +370,22 @@ class Ctx:
     def uidvalidity(self):
         return self._con.uidvalidity
 
+    @property
+    def exists(self):
+        return self._con.exists
+
+    @property
+    def highestmodseq(self):
+        return self._con.highestmodseq
+
+    @property
+    def synced(self):
+        return self._con.synced
+
+    @synced.setter
+    def synced(self, value):
+        self._con.synced = value
+
     def __enter__(self):
         return self
 
@@ -200,12 +393,83 @@ class Ctx:
         self.logout()
 
 
-def client(connect, *, writable=False, dovecot=False, debug=None):
+class DeflateSocket:
+    """Socket wrapper for COMPRESS=DEFLATE (RFC 4978)."""
+    def __init__(self, sock):
+        self._sock = sock
+        self._compress = zlib.compressobj(
+            zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15
+        )
+        self._decompress = zlib.decompressobj(-15)
+        self._buf = b''
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
+
+    def sendall(self, data):
+        data = self._compress.compress(data)
+        data += self._compress.flush(zlib.Z_SYNC_FLUSH)
+        return self._sock.sendall(data)
+
+    def readinto(self, b):
+        while not self._buf:
+            data = self._sock.recv(16384)
+            if not data:
+                return 0
+            self._buf = self._decompress.decompress(data)
+        size = min(len(b), len(self._buf))
+        b[:size] = self._buf[:size]
+        self._buf = self._buf[size:]
+        return size
+
+    def makefile(self, mode='rb'):
+        return io.BufferedReader(DeflateReader(self))
+
+
+class DeflateReader(io.RawIOBase):
+    def __init__(self, sock):
+        self.sock = sock
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        return self.sock.readinto(b)
+
+
+@command()
+def capabilities(con):
+    caps = check(con.capability())
+    return set(caps[0].decode().upper().split()) if caps and caps[0] else set()
+
+
+def enable_compress(con):
+    if 'COMPRESS=DEFLATE' not in capabilities(con):
+        log.debug('%s: no COMPRESS=DEFLATE support', con)
+        return False
+
+    with _cmd(con, 'COMPRESS') as (tag, start, complete):
+        start(b' DEFLATE' + CRLF)
+        typ, data = complete()
+    if typ != 'OK':
+        log.error('%s: COMPRESS=DEFLATE is failed: %s', con, data)
+        return False
+
+    con.sock = DeflateSocket(con.sock)
+    con.file = con.sock.makefile('rb')
+    return True
+
+
+def client(
+    connect, *, writable=False, dovecot=False, debug=None, compress=False
+):
     def start():
         con = connect()
         con.debug = conf['DEBUG_IMAP'] if debug is None else debug
         con.lock = RLock()
         con.new = new
+        if compress:
+            enable_compress(con)
         return con
 
     def new():
@@ -245,6 +509,24 @@ def _cmd(con, name):
     yield tag, start, lambda: con._command_complete(name, tag)
 
 
+@command()
+def enable(con, *names):
+    """ENABLE extensions (RFC 5161) if server supports them."""
+    caps = capabilities(con)
+    names = [i.upper() for i in names if i.upper() in caps]
+    if not names:
+        return con.enabled
+
+    with _cmd(con, 'ENABLE') as (tag, start, complete):
+        start((' %s' % ' '.join(names)).encode() + CRLF)
+        typ, data = complete()
+    if typ != 'OK':
+        raise Error(typ, data)
+    for line in con.untagged_responses.pop('ENABLED', []):
+        con.enabled.update(line.decode().upper().split())
+    return con.enabled
+
+
 def _mdkey(key):
     if not key.startswith('/private'):
         key = '/private/%s' % key
@@ -302,23 +584,36 @@ def clean_recent(flags):
 
 
 def _multiappend(con, box, msgs):
+    # with LITERAL+ messages are sent without waiting for continuations
+    nonsync = 'LITERAL+' in con.capabilities
+    literal = '{%s+}' if nonsync else '{%s}'
     with _cmd(con, 'APPEND') as (tag, start, complete):
         send = start
-        for date_time, flags, msg in msgs:
-            flags = clean_recent(flags)
-            if date_time is None:
-                date_time = Time2Internaldate(time.time())
-            args = (' (%s) %s %s' % (flags, date_time, '{%s}' % len(msg)))
-            if send == start:
-                args = ' %s %s' % (box, args)
-            send(args.encode() + CRLF)
-            send = con.send
-            while con._get_response():
-                bad = con.tagged_commands[tag]
-                if bad:
-                    raise Error(bad)
-            con.send(msg)
-        con.send(CRLF)
+        sent = False
+        try:
+            for date_time, flags, msg in msgs:
+                flags = clean_recent(flags)
+                if date_time is None:
+                    date_time = Time2Internaldate(time.time())
+                args = (
+                    ' (%s) %s %s' % (flags, date_time, literal % len(msg))
+                )
+                if send == start:
+                    args = ' %s %s' % (box, args)
+                send(args.encode() + CRLF)
+                send = con.send
+                while not nonsync and con._get_response():
+                    bad = con.tagged_commands[tag]
+                    if bad:
+                        raise Error(bad)
+                con.send(msg)
+            con.send(CRLF)
+            sent = True
+        finally:
+            if not sent and send != start:
+                # unfinished APPEND can't be cancelled, drop the connection
+                log.error('%s: APPEND is interrupted', con)
+                con.shutdown()
         res = check(complete())
         log.debug('%s', res[0].decode())
         uids = con.untagged_responses.pop('APPENDUID')
@@ -328,6 +623,15 @@ def _multiappend(con, box, msgs):
 
 @command(dovecot=True, writable=True, lock=False)
 def multiappend(con, box, msgs, *, batch=None, threads=10):
+    if not isinstance(msgs, (list, tuple)):
+        # an iterator: messages are sent as soon as they are produced
+        msgs = iter(msgs)
+        first = next(msgs, None)
+        if first is None:
+            return
+        with con.lock:
+            return _multiappend(con, box, it.chain([first], msgs))
+
     if not msgs:
         return
 
@@ -395,6 +699,11 @@ def idle(con, handler, code='EXISTS', timeout=None):
 
 
 @command()
+def noop(con):
+    return check(con.noop())
+
+
+@command(guard=False)
 def logout(con, timeout=1):
     with Timeout(timeout):
         try:
@@ -408,13 +717,51 @@ def xlist(con, folder='""', pattern='*'):
     return check(con.list(folder, pattern))
 
 
+def is_changed(con):
+    exists = con.untagged_responses.get('EXISTS')
+    if exists and exists[-1] != con.exists:
+        return True
+    return bool(con.untagged_responses.get('EXPUNGE'))
+
+
+def sync_selected(con):
+    check(con.noop())
+    flags = con.untagged_responses.get('FLAGS')
+    if flags:
+        con.flags = flags[-1].decode()[1:-1].split()
+    if is_changed(con):
+        res = check(con.status(con.current_box, '(UIDNEXT MESSAGES)'))
+        res = res[0].decode()
+        con.uidnext = int(re.search(r'UIDNEXT (\d+)', res).group(1))
+        con.exists = re.search(r'MESSAGES (\d+)', res).group(1).encode()
+        con.untagged_responses['EXISTS'] = [con.exists]
+        con.untagged_responses.pop('EXPUNGE', None)
+    con.synced = True
+
+
 @command()
-def select(con, box, readonly=True):
+def select(con, box, readonly=True, fresh=False):
+    box = box.decode() if isinstance(box, bytes) else box
+    is_selected = (
+        con.state == 'SELECTED' and
+        con.current_box == box and
+        con.is_readonly == readonly
+    )
+    if is_selected:
+        if fresh or not con.synced or is_changed(con):
+            sync_selected(con)
+        return [con.exists]
+
+    con.current_box = None
     res = check(con.select(box, readonly))
-    con.current_box = box.decode() if isinstance(box, bytes) else box
+    con.current_box = box
     con.flags = con.untagged_responses['FLAGS'][0].decode()[1:-1].split()
     con.uidnext = int(con.untagged_responses['UIDNEXT'][0].decode())
     con.uidvalidity = con.untagged_responses['UIDVALIDITY'][0].decode()
+    con.exists = res[-1]
+    modseq = con.untagged_responses.get('HIGHESTMODSEQ')
+    con.highestmodseq = int(modseq[-1].decode()) if modseq else None
+    con.synced = True
     return res
 
 
@@ -448,14 +795,66 @@ def search(con, *criteria):
     return res[0].decode().split()
 
 
+@command(dovecot=True)
+def pipeline(con, cmds):
+    """Send several UID commands at once, then collect results in order.
+
+    "cmds" is a list like [('SEARCH', 'keyword #1'), ('STORE', ...)].
+    SEARCH is sent with "RETURN (ALL)", so results are matched to commands
+    by tags of ESEARCH responses and returned as lists of uids.
+    STORE should be ".SILENT", untagged FETCH responses aren't returned.
+    """
+    if not cmds:
+        return []
+
+    tags = []
+    for name, *args in cmds:
+        name = name.upper()
+        if name == 'STORE' and not args[1].upper().endswith('.SILENT'):
+            raise ValueError('STORE must be silent in pipeline: %s' % args)
+        elif name == 'SEARCH':
+            args = ['RETURN (ALL)'] + list(args)
+        tag = con._new_tag()
+        line = ' '.join(['UID', name] + list(args))
+        con.send(b'%s %s%s' % (tag, line.encode(con._encoding), CRLF))
+        tags.append((tag, name))
+
+    for tag, name in tags:
+        while not con.tagged_commands[tag]:
+            con._get_response()
+    # flags changed by other sessions are reported anyway
+    con.untagged_responses.pop('FETCH', None)
+
+    found = {}
+    for line in con.untagged_responses.pop('ESEARCH', []):
+        m = re.match(br'\(TAG "([^"]+)"\) UID(?: ALL (\S+))?', line)
+        if m:
+            found[m.group(1)] = m.group(2)
+
+    results = []
+    errors = []
+    for tag, name in tags:
+        typ, data = con.tagged_commands.pop(tag)
+        if typ != 'OK':
+            errors.append((name, typ, data))
+        elif name == 'SEARCH':
+            results.append(list(UidSet(found.get(tag) or '')))
+        else:
+            results.append(data)
+    if errors:
+        raise Error(*errors)
+    return results
+
+
 @command(writable=True)
 def append(con, box, flags, date_time, msg):
     check(con.append(box, clean_recent(flags), date_time, msg))
     uidlatest = con.untagged_responses.pop('APPENDUID')
     uidlatest = uidlatest[0].decode().split(' ', 1)[-1]
-    # update "uidnext" because some stuff is relying on it
-    # for example metadata cache
-    con.uidnext = str(int(uidlatest) + 1)
+    if box == con.current_box:
+        # update "uidnext" because some stuff is relying on it
+        # for example metadata cache
+        con.uidnext = int(uidlatest) + 1
     return uidlatest
 
 
@@ -467,7 +866,7 @@ def expunge(con):
 
 @command()
 def copy(con, uids, box):
-    return check(con.uid('COPY', ','.join(uids), box))
+    return check(con.uid('COPY', Uids(uids).str, box))
 
 
 @command(lock=False)
@@ -485,6 +884,71 @@ def fetch(con, uids, fields):
     return res
 
 
+def _fetch_iter(con, uids, fields):
+    with con.lock, _cmd(con, 'UID FETCH') as (tag, start, complete):
+        requested = fetch_request(uids, fields)
+        uids = uids.str
+        uids = uids.encode() if isinstance(uids, str) else uids
+        # drop unsolicited responses, they don't belong to this command
+        con.untagged_responses.pop('FETCH', None)
+        start(b' %s %s%s' % (uids, fields.encode(), CRLF))
+        con.streaming = getcurrent()
+        try:
+            while not con.tagged_commands[tag]:
+                con._get_response()
+                res = con.untagged_responses.pop('FETCH', [])
+                for item in fetch_items(res):
+                    rec = Fetched(*parse_fetch(item))
+                    if requested(rec):
+                        yield rec.uid, rec
+        finally:
+            try:
+                # read the rest of responses if iteration is stopped earlier
+                while not con.tagged_commands[tag]:
+                    con._get_response()
+                    con.untagged_responses.pop('FETCH', None)
+                typ, data = con.tagged_commands.pop(tag)
+            finally:
+                con.streaming = None
+        if typ != 'OK':
+            raise Error(typ, data)
+
+
+@command(lock=False)
+def fetch_iter(con, uids, fields):
+    """Like "fetch", but yields (uid, Fetched) as responses arrive.
+
+    The connection is locked until the iterator is drained or closed,
+    so other commands shouldn't be sent while it's consumed.
+    """
+    uids = Uids(uids)
+    if not uids.val:
+        return
+
+    desc = fn_desc(fetch_iter, con, uids, fields)
+    for few in uids.batches or [uids]:
+        yield from fn_time(_fetch_iter, desc)(con, few, fields)
+
+
+@command(lock=False)
+def fetch_changes(con, uids, modseq, fields='(UID FLAGS)'):
+    """Messages changed since "modseq" (RFC 7162): (records, vanished).
+
+    Expunged uids are reported only if QRESYNC is enabled.
+    """
+    modifiers = 'CHANGEDSINCE %s' % modseq
+    if 'QRESYNC' in con.enabled:
+        modifiers += ' VANISHED'
+    con.untagged_responses.pop('VANISHED', None)
+    fields = '%s (%s)' % (fields, modifiers)
+    res = [rec for uid, rec in fetch_iter(con, uids, fields)]
+    vanished = UidSet()
+    for line in con.untagged_responses.pop('VANISHED', []):
+        # "(EARLIER) 1:3,5" or just "1:3,5" for unsolicited response
+        vanished |= UidSet(line.split()[-1])
+    return res, vanished
+
+
 @command(lock=False, writable=True)
 @cmd_writable
 def store(con, uids, cmd, flags):
@@ -545,26 +1009,310 @@ def parse_thread(line):
     return Threads(threads, all_uids)
 
 
-def pack_uids(uids):
-    uids = sorted(int(i) for i in uids)
-    result = ''
-    for i, uid in enumerate(uids):
-        if i == 0:
-            result += str(uid)
-        elif uid - uids[i-1] == 1:
-            if len(uids) == (i + 1):
-                if not result.endswith(':'):
-                    result += ':'
-                result += str(uid)
-            elif result.endswith(':'):
-                pass
-            else:
-                result += ':'
-        elif result.endswith(':'):
-            result += '%d,%d' % (uids[i-1], uid)
+def fetch_items(res):
+    """Group imaplib FETCH response by message."""
+    item = []
+    for part in res:
+        if part is None:
+            continue
+        item.append(part)
+        if not isinstance(part, tuple):
+            yield item
+            item = []
+
+
+fetch_tokens = re.compile(br'''
+    [ ]*(?:
+    (?P<open>\() |
+    (?P<close>\)) |
+    "(?P<quoted>(?:[^"\\]|\\.)*)" |
+    (?P<literal>\x00) |
+    (?P<atom>(?:[^ ()"\x00\[]|\[[^\]]*\])+(?:<\d+>)?)
+    )
+''', re.VERBOSE)
+fetch_literal = re.compile(br'~?\{\d+\}$')
+
+
+def parse_fetch(item):
+    """Parse one FETCH response into (seq, {name: value}).
+
+    Literals are kept as bytes, atoms and quoted strings are decoded,
+    NIL is None, parenthesized lists become python lists.
+    """
+    if not isinstance(item, list):
+        item = [item]
+    line = []
+    literals = []
+    for part in item:
+        if isinstance(part, tuple):
+            head, literal = part
+            line.append(fetch_literal.sub(b'\x00', head))
+            literals.append(literal)
         else:
-            result += ',%s' % uid
-    return result
+            line.append(part)
+    line = b''.join(line)
+
+    literals = iter(literals)
+    stack = [[]]
+    pos = 0
+    end = len(line.rstrip())
+    while pos < end:
+        m = fetch_tokens.match(line, pos)
+        if not m or m.end() == pos:
+            raise Error('Unexpected FETCH response: %r' % line[pos:])
+        pos = m.end()
+        kind = m.lastgroup
+        if kind == 'open':
+            stack.append([])
+        elif kind == 'close':
+            val = stack.pop()
+            stack[-1].append(val)
+        elif kind == 'literal':
+            stack[-1].append(next(literals))
+        elif kind == 'quoted':
+            val = m.group('quoted').decode()
+            stack[-1].append(re.sub(r'\\(.)', r'\1', val))
+        else:
+            val = m.group('atom').decode()
+            stack[-1].append(None if val == 'NIL' else val)
+
+    seq, attrs = stack[0][:2]
+    items = {}
+    for i in range(0, len(attrs) - 1, 2):
+        items[attrs[i].upper()] = attrs[i + 1]
+    return seq, items
+
+
+class Flags(frozenset):
+    """Flags of a message, iteration keeps the order of the response."""
+    __slots__ = ['order']
+
+    def __new__(cls, flags=()):
+        flags = tuple(flags)
+        obj = frozenset.__new__(cls, flags)
+        obj.order = flags
+        return obj
+
+    def __iter__(self):
+        return iter(self.order)
+
+    def __str__(self):
+        return ' '.join(self.order)
+
+    def __repr__(self):
+        return 'Flags(%r)' % (self.order,)
+
+
+class Fetched:
+    """Parsed FETCH response of one message.
+
+    Literal sections (BODY[...], BINARY[...]) are in "parts" and available
+    by name: rec['BODY[]'], Gmail attributes (X-GM-*) are in "gm".
+    """
+    __slots__ = [
+        'seq', 'uid', 'flags', 'modseq', 'internaldate', 'parts', 'gm'
+    ]
+
+    def __init__(self, seq, items):
+        self.seq = seq
+        self.uid = items.pop('UID', None)
+        flags = items.pop('FLAGS', None)
+        self.flags = None if flags is None else Flags(flags)
+        modseq = items.pop('MODSEQ', None)
+        self.modseq = int(modseq[0]) if modseq else None
+        self.internaldate = items.pop('INTERNALDATE', None)
+        self.gm = {}
+        self.parts = {}
+        for name, value in items.items():
+            if name.startswith('X-GM-'):
+                self.gm[name] = value
+            elif isinstance(value, str):
+                self.parts[name] = value.encode()
+            else:
+                self.parts[name] = value
+
+    def __getitem__(self, name):
+        return self.parts[name]
+
+    def get(self, name, default=None):
+        return self.parts.get(name, default)
+
+    def __repr__(self):
+        return 'Fetched(%r, %r)' % (self.uid, self.flags)
+
+
+def fetched(res, uids=None, fields=None):
+    """Parse the result of "fetch" into Fetched records.
+
+    With "uids" and "fields" of the request unsolicited FETCH responses
+    are dropped, see "fetch_request".
+    """
+    recs = [Fetched(*parse_fetch(item)) for item in fetch_items(res)]
+    if uids is not None:
+        requested = fetch_request(uids, fields)
+        recs = [rec for rec in recs if requested(rec)]
+    return recs
+
+
+def fetch_request(uids, fields):
+    """Check if a Fetched record answers the request "UID FETCH uids fields".
+
+    Unsolicited FETCH responses (flags changed by another session) can
+    come in between, they have other uids or lack requested sections.
+    """
+    uids = Uids(uids).str
+    uids = uids.decode() if isinstance(uids, bytes) else uids
+    uids = None if '*' in uids else UidSet(uids)
+    sections = [
+        '%s[%s]%s' % (kind, section, '<%s>' % start if start else '')
+        for kind, section, start in re.findall(
+            r'(BODY|BINARY)(?:\.PEEK)?\[([^\]]*)\](?:<(\d+)\.\d+>)?',
+            fields.upper()
+        )
+    ]
+
+    def requested(rec):
+        if not rec.uid or uids is not None and rec.uid not in uids:
+            return False
+        return all(name in rec.parts for name in sections)
+    return requested
+
+
+class UidSet:
+    """Sorted set of UIDs stored as ranges: "1:4,7,10:12".
+
+    Iteration yields UIDs as strings like the rest of the code uses them.
+    """
+    __slots__ = ['ranges']
+
+    def __init__(self, uids=()):
+        if isinstance(uids, UidSet):
+            self.ranges = array('L', uids.ranges)
+            return
+        if isinstance(uids, bytes):
+            uids = uids.decode()
+        if isinstance(uids, str):
+            pairs = []
+            for part in uids.split(','):
+                if not part:
+                    continue
+                start, _, end = part.partition(':')
+                start, end = int(start), int(end or start)
+                pairs.append((min(start, end), max(start, end)))
+            pairs.sort()
+            self.ranges = self._merge(pairs)
+            return
+
+        uids = [int(i) for i in uids]
+        if any(a > b for a, b in zip(uids, uids[1:])):
+            uids.sort()
+        ranges = array('L')
+        for uid in uids:
+            if ranges and uid <= ranges[-1] + 1:
+                if uid > ranges[-1]:
+                    ranges[-1] = uid
+            else:
+                ranges.extend((uid, uid))
+        self.ranges = ranges
+
+    @staticmethod
+    def _merge(pairs):
+        ranges = array('L')
+        for start, end in pairs:
+            if ranges and start <= ranges[-1] + 1:
+                if end > ranges[-1]:
+                    ranges[-1] = end
+            else:
+                ranges.extend((start, end))
+        return ranges
+
+    @classmethod
+    def from_ranges(cls, ranges):
+        obj = cls.__new__(cls)
+        obj.ranges = ranges
+        return obj
+
+    def pairs(self):
+        r = self.ranges
+        return zip(r[::2], r[1::2])
+
+    def __or__(self, other):
+        other = other if isinstance(other, UidSet) else UidSet(other)
+        pairs = sorted(it.chain(self.pairs(), other.pairs()))
+        return self.from_ranges(self._merge(pairs))
+
+    def __and__(self, other):
+        other = other if isinstance(other, UidSet) else UidSet(other)
+        a, b = self.ranges, other.ranges
+        ranges = array('L')
+        i = j = 0
+        while i < len(a) and j < len(b):
+            start, end = max(a[i], b[j]), min(a[i+1], b[j+1])
+            if start <= end:
+                ranges.extend((start, end))
+            if a[i+1] < b[j+1]:
+                i += 2
+            else:
+                j += 2
+        return self.from_ranges(ranges)
+
+    def __sub__(self, other):
+        other = other if isinstance(other, UidSet) else UidSet(other)
+        b = other.ranges
+        ranges = array('L')
+        j = 0
+        for start, end in self.pairs():
+            while j < len(b) and b[j+1] < start:
+                j += 2
+            k = j
+            while start <= end and k < len(b) and b[k] <= end:
+                if b[k] > start:
+                    ranges.extend((start, b[k] - 1))
+                start = max(start, b[k+1] + 1)
+                k += 2
+            if start <= end:
+                ranges.extend((start, end))
+        return self.from_ranges(ranges)
+
+    def __contains__(self, uid):
+        uid = int(uid)
+        i = bisect.bisect_right(self.ranges, uid)
+        return bool(i % 2 or (i and self.ranges[i-1] == uid))
+
+    def __iter__(self):
+        for start, end in self.pairs():
+            for uid in range(start, end + 1):
+                yield str(uid)
+
+    def __len__(self):
+        return sum(end - start + 1 for start, end in self.pairs())
+
+    def __bool__(self):
+        return bool(self.ranges)
+
+    def __eq__(self, other):
+        if not isinstance(other, UidSet):
+            return NotImplemented
+        return self.ranges == other.ranges
+
+    def split(self, size):
+        """Split into sets with at most "size" ranges each."""
+        step = size * 2
+        for i in range(0, len(self.ranges), step):
+            yield self.from_ranges(self.ranges[i:i+step])
+
+    def __str__(self):
+        return ','.join(
+            str(start) if start == end else '%d:%d' % (start, end)
+            for start, end in self.pairs()
+        )
+
+    def __repr__(self):
+        return 'UidSet(%r)' % str(self)
+
+
+def pack_uids(uids):
+    return str(UidSet(uids))
 
 
 class Uids:
@@ -576,7 +1324,13 @@ class Uids:
         self.threads = threads
         self.val = uids
         self.batches = None
-        if not self.is_str and len(uids) > batch:
+        if isinstance(uids, UidSet):
+            # the size of command depends on amount of ranges here
+            if len(uids.ranges) > batch * 2:
+                self.batches = tuple(
+                    Uids(few, batch=batch) for few in uids.split(batch)
+                )
+        elif not self.is_str and len(uids) > batch:
             self.batches = tuple(
                 Uids(uids[i:i+batch], batch=batch)
                 for i in range(0, len(uids), batch)
@@ -586,7 +1340,7 @@ class Uids:
     def str(self):
         if self.is_str:
             return self.val
-        return ','.join(str(i) for i in self.val)
+        return str(UidSet(self.val))
 
     @property
     def is_str(self):
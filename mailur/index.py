@@ -0,0 +1,147 @@
+"""Optional SQLite storage for metadata (enabled by METADATA_DB).
+
+Every metadata record is kept as rows of items ("path" is a JSON list)
+with a version which is increased on every write. Only records built from
+"mlr/All" are kept here, "mlr metadata --rebuild" restores them.
+"""
+import os
+import re
+import sqlite3
+from contextlib import contextmanager
+
+from . import conf, json
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS records (
+    name TEXT PRIMARY KEY,
+    version INTEGER NOT NULL,
+    root TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS items (
+    name TEXT NOT NULL,
+    path TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (name, path)
+) WITHOUT ROWID;
+'''
+
+connections = {}
+
+
+def enabled():
+    return bool(conf['METADATA_DB'])
+
+
+def path():
+    return os.path.join(conf['METADATA_DB'], conf['USER'], 'index.db')
+
+
+def connect():
+    db = connections.get(conf['USER'])
+    if db is None:
+        filename = path()
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        db = sqlite3.connect(
+            filename, isolation_level=None, check_same_thread=False
+        )
+        # readers don't block the writer and vice versa
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.executescript(SCHEMA)
+        connections[conf['USER']] = db
+    return db
+
+
+@contextmanager
+def transaction():
+    db = connect()
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        yield db
+    except Exception:
+        db.execute('ROLLBACK')
+        raise
+    else:
+        db.execute('COMMIT')
+
+
+def version(name):
+    row = connect().execute(
+        'SELECT version FROM records WHERE name = ?', (name,)
+    ).fetchone()
+    return row[0] if row else None
+
+
+def names():
+    return [i for i, in connect().execute('SELECT name FROM records')]
+
+
+def load(name):
+    """Root container and items: (root, [[path, value], ...])."""
+    db = connect()
+    root = db.execute(
+        'SELECT root FROM records WHERE name = ?', (name,)
+    ).fetchone()
+    if not root:
+        return None, []
+    rows = db.execute(
+        'SELECT path, value FROM items WHERE name = ?',
+        (name,)
+    )
+    return json.loads(root[0]), [
+        [json.loads(path), json.loads(value)] for path, value in rows
+    ]
+
+
+def lookup(name, path):
+    """Value of one item by its path or None."""
+    row = connect().execute(
+        'SELECT value FROM items WHERE name = ? AND path = ?',
+        (name, json.dumps(list(path)))
+    ).fetchone()
+    return json.loads(row[0]) if row else None
+
+
+def prefix(item):
+    """Pattern for LIKE to match items inside of the item."""
+    start = json.dumps(list(item))[:-1] + ','
+    return re.sub(r'([\\%_])', r'\\\1', start) + '%'
+
+
+def save(name, delta, root=None):
+    """Apply delta {"rm": [path...], "set": [[path, value]...]} at once.
+
+    Removed paths are removed with items inside of them.
+    With "root" all previous items are replaced. Returns the new version.
+    """
+    with transaction() as db:
+        if root is not None:
+            db.execute('DELETE FROM items WHERE name = ?', (name,))
+            db.execute(
+                'INSERT OR REPLACE INTO records (name, version, root) '
+                'VALUES (?, COALESCE('
+                '  (SELECT version FROM records WHERE name = ?), 0'
+                '), ?)',
+                (name, name, json.dumps(root))
+            )
+        db.executemany(
+            'DELETE FROM items WHERE name = ? AND '
+            "(path = ? OR path LIKE ? ESCAPE '\\')",
+            (
+                (name, json.dumps(list(p)), prefix(p))
+                for p in delta.get('rm', [])
+            )
+        )
+        db.executemany(
+            'INSERT OR REPLACE INTO items (name, path, value) '
+            'VALUES (?, ?, ?)',
+            (
+                (name, json.dumps(list(p)), json.dumps(v))
+                for p, v in delta.get('set', [])
+            )
+        )
+        db.execute(
+            'UPDATE records SET version = version + 1 WHERE name = ?',
+            (name,)
+        )
+    return version(name)
@@ -1,18 +1,39 @@
+import base64
+import bisect
 import email
 import functools as ft
 import hashlib
 import imaplib
+import itertools as it
 import re
+import struct
+import sys
 import textwrap
+import zlib
+from array import array
+from collections.abc import Mapping, MutableMapping
+from contextlib import ExitStack, contextmanager
 
-from gevent import joinall, socket, spawn
+from gevent import getcurrent, joinall, socket, spawn
 
-from . import cache, conf, fn_time, html, imap, json, lock, log, message
+from . import (
+    cache, conf, fn_time, html, imap, index, json, lock, log, message
+)
 
 SRC = 'mlr'
 ALL = 'mlr/All'
 SYS = 'mlr/Sys'
 DEL = 'mlr/Del'
+# amount of uids in one shard of "data_msgs" and "data_threads"
+SHARD_SIZE = 10000
+# header of binary metadata records, the last byte is the format version
+METADATA_MAGIC = b'MLR\x01'
+# snapshot split into buckets of keys, which can be fetched separately
+METADATA_BUCKETS = b'MLR\x02'
+METADATA_BUCKET_SIZE = 1000
+# called with uids of SRC expunged by "msgs_flag", "remote" drops them
+# from the index of imported messages
+expunge_hooks = []
 
 
 class Local(imaplib.IMAP4, imap.Conn):
@@ -42,7 +63,10 @@ def master_login(key='MASTER', username=None):
 
 def client(box=ALL, *, master='MASTER', readonly=True):
     connect_fn = ft.wraps(connect)(ft.partial(connect, *master_login(master)))
-    ctx = imap.client(connect_fn, dovecot=True, writable=True)
+    ctx = imap.client(
+        connect_fn, dovecot=True, writable=True,
+        compress='local' in conf['IMAP_COMPRESS']
+    )
     if box:
         ctx.select(box, readonly=readonly)
     return ctx
@@ -52,129 +76,1104 @@ def using(box=ALL, **kw):
     return imap.using(client, box, **kw)
 
 
-@using(SYS)
+@using(SYS, fresh=True)
 def metadata_uids(con=None):
-    def get_map():
-        uids = {}
-        all_uids = set()
-        res = con.fetch('1:*', '(UID BODY[HEADER.FIELDS (Subject)])')
-        for i in range(0, len(res), 2):
-            uid = res[i][0].decode().split()[2]
-            name = re.sub(r'^Subject: ?', '', res[i][1].decode()).strip()
-            if name not in uids or int(uids[name]) < int(uid):
-                uids[name] = uid
-            all_uids.add(uid)
-        clean = all_uids.difference(uids.values())
-        if clean and len(clean) > 100:
+    """Uids of metadata records: {name: [snapshot, *deltas]}.
+
+    The map is updated only with records appended after the last call,
+    it's built from scratch if some records are expunged by somebody else.
+    """
+    def fetch(uids, uidnext=None):
+        found = []
+        res = con.fetch_iter(
+            uids, '(UID FLAGS BODY[HEADER.FIELDS (Subject)])'
+        )
+        for uid, rec in res:
+            if uidnext and int(uid) < uidnext:
+                # "uidnext:*" returns the last message if there are no new
+                continue
+            name = rec['BODY[HEADER.FIELDS (SUBJECT)]'].decode()
+            name = re.sub(r'^Subject: ?', '', name).strip()
+            found.append((int(uid), uid, name, '#delta' in rec.flags))
+        return sorted(found)
+
+    def merge(state, found):
+        uids = dict(state['map'])
+        clean = list(state['clean'])
+        for _, uid, name, delta in found:
+            if not delta:
+                clean.extend(uids.get(name, []))
+                uids[name] = [uid]
+            elif name in uids:
+                uids[name] = uids[name] + [uid]
+            else:
+                clean.append(uid)
+        return {
+            'uidnext': con.uidnext,
+            'exists': state['exists'] + len(found),
+            'map': uids,
+            'clean': clean,
+        }
+
+    def get_map(state=None):
+        if state:
+            uidnext = state['uidnext']
+            state = merge(state, fetch('%s:*' % uidnext, uidnext))
+        if not state or state['exists'] != int(con.exists):
+            empty = {'exists': 0, 'map': {}, 'clean': []}
+            state = merge(empty, fetch('1:*'))
+
+        if len(state['clean']) > 100:
             with client(SYS, readonly=False) as c:
-                c.store(clean, '+FLAGS.SILENT', '\\Deleted')
+                c.store(state['clean'], '+FLAGS.SILENT', '\\Deleted')
                 c.expunge()
-        return uids
+            state['exists'] -= len(state['clean'])
+            state['clean'] = []
+        return state
 
     get_map = fn_time(get_map, 'metadata_uids.get_map')
 
-    cache_key = 'metadata'
-    value = cache.get(cache_key)
-    if not value or con.uidnext != value['uidnext']:
-        data = {'uidnext': con.uidnext, 'map': get_map()}
-        cache.set(cache_key, data)
-    return cache.get(cache_key)['map']
+    def is_actual(state):
+        return state and (
+            state['uidnext'] == con.uidnext and
+            state['exists'] == int(con.exists)
+        )
+
+    cache_key = 'metadata:uids'
+    state = cache.get(cache_key)
+    if state and state['uidvalidity'] != con.uidvalidity:
+        state = None
+    if not is_actual(state):
+        state = get_map(state)
+        state['uidvalidity'] = con.uidvalidity
+        cache.set(cache_key, state)
+    return state['map']
+
+
+class Tracked(dict):
+    """Dict which knows keys changed since loading or saving."""
+    __slots__ = ['changed']
+
+    def __init__(self, *a, **kw):
+        super().__init__(*a, **kw)
+        self.changed = set()
+
+    def __setitem__(self, key, value):
+        self.changed.add(key)
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self.changed.add(key)
+        super().__delitem__(key)
+
+    def pop(self, key, *default):
+        if key in self:
+            self.changed.add(key)
+        return super().pop(key, *default)
+
+    def popitem(self):
+        key, value = super().popitem()
+        self.changed.add(key)
+        return key, value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *a, **kw):
+        for key, value in dict(*a, **kw).items():
+            self[key] = value
+
+    def clear(self):
+        self.changed.update(self)
+        super().clear()
+
+
+def metadata_paths(value, depth, path=()):
+    """Paths of items up to "depth" levels."""
+    paths = []
+
+    def walk(path, val, keep=True):
+        # an empty dict is an item itself, but not inside of the root list
+        if not path and isinstance(val, (list, tuple)):
+            keys = enumerate(val)
+        elif isinstance(val, Mapping) and (val or keep):
+            keys = val.items()
+        else:
+            keys = None
+
+        if keys is None or len(path) >= depth:
+            paths.append(path)
+            return
+        for key, v in keys:
+            walk(path + (key,), v, keep=not isinstance(val, Mapping))
+
+    walk(path, value)
+    return paths
+
+
+def metadata_count(value, depth):
+    """Approximate number of items, only containers of items are counted."""
+    nodes = [value]
+    for i in range(depth - 1):
+        nodes = [
+            v for node in nodes
+            for v in (node.values() if isinstance(node, Mapping) else node)
+            if isinstance(v, (Mapping, list, tuple))
+        ]
+    return sum(len(node) for node in nodes)
+
+
+def metadata_track(value, depth, clear=False):
+    """Containers of items become "Tracked", so changes are known.
+
+    With "clear" changes are forgotten, it's used after loading or saving.
+    """
+    def track(val, level):
+        if level >= depth or not isinstance(val, Mapping):
+            return val
+        if not hasattr(val, 'changed'):
+            val = Tracked(val)
+        if clear:
+            val.changed.clear()
+        if level + 1 < depth and isinstance(val, dict):
+            for key, sub in val.items():
+                new = track(sub, level + 1)
+                if new is not sub:
+                    dict.__setitem__(val, key, new)
+        return val
+
+    if isinstance(value, (list, tuple)):
+        return [track(i, 1) for i in value]
+    return track(value, 0)
+
+
+def metadata_changes(value, old, depth):
+    """Paths of items changed since loading: (changed, removed).
+
+    It's None if the value isn't the loaded one, so changes are unknown.
+    """
+    changed, removed = [], []
+
+    def walk(path, val, old):
+        if val is not old or not hasattr(val, 'changed'):
+            return False
+
+        deeper = len(path) + 1 < depth
+        for key in val.changed:
+            item = path + (key,)
+            if key not in val:
+                removed.append(item)
+            elif deeper and isinstance(val[key], Mapping) and val[key]:
+                # the whole container is replaced
+                removed.append(item)
+                changed.extend(metadata_paths(val[key], depth, item))
+            else:
+                changed.append(item)
+        if not deeper:
+            return True
+        for key, sub in val.items():
+            if key in val.changed or not isinstance(sub, Mapping):
+                continue
+            elif not walk(path + (key,), sub, sub):
+                return False
+        return True
+
+    if isinstance(value, (list, tuple)):
+        if not isinstance(old, (list, tuple)) or len(old) != len(value):
+            return None
+        found = all(walk((i,), v, old[i]) for i, v in enumerate(value))
+    else:
+        found = walk((), value, old)
+    return (changed, removed) if found else None
+
+
+def metadata_unmark(value, delta):
+    """Items from a delta of another process aren't changed here."""
+    paths = delta.get('rm', []) + [p for p, _ in delta.get('set', [])]
+    for path in paths:
+        if not path:
+            continue
+        try:
+            parent = metadata_value(value, path[:-1])
+        except (KeyError, IndexError, TypeError):
+            continue
+        if hasattr(parent, 'changed'):
+            parent.changed.discard(path[-1])
+
+
+def metadata_value(value, path):
+    for key in path:
+        value = value[key]
+    return value
+
+
+def metadata_apply(value, delta):
+    """Apply delta record {"rm": [path...], "set": [[path, value]...]}."""
+    for path in delta.get('rm', []):
+        try:
+            parent = metadata_value(value, path[:-1])
+            del parent[path[-1]]
+        except (KeyError, IndexError, TypeError):
+            continue
+
+    for path, val in delta.get('set', []):
+        if not path:
+            value = val
+            continue
+        parent = value
+        for key in path[:-1]:
+            if isinstance(parent, Mapping) and not isinstance(
+                parent.get(key), Mapping
+            ):
+                parent[key] = {}
+            parent = parent[key]
+        parent[path[-1]] = val
+    return value
+
+
+def metadata_rows(value, paths):
+    return [[list(p), metadata_value(value, p)] for p in paths]
+
+
+def metadata_plain(value):
+    """Value ready for JSON, a custom mapping is turned into dict."""
+    if isinstance(value, Mapping) and not isinstance(value, dict):
+        return dict(value)
+    return value
+
+
+def metadata_pack(value):
+    return zlib.compress(json.dumps(value).encode())
+
+
+def metadata_unpack(data):
+    return json.loads(zlib.decompress(data).decode())
+
+
+def metadata_dumps(value, buckets=False):
+    """Binary record: header and zlib compressed JSON.
+
+    With "buckets" a dict is split by keys into separately compressed
+    buckets, offsets of buckets are saved after the header:
+    b'MLR\\x02' | count | (offset, length) * count | buckets
+    """
+    value = metadata_plain(value)
+    if isinstance(value, tuple):
+        value = list(value)
+    if not buckets or not isinstance(value, dict):
+        return METADATA_MAGIC + metadata_pack(value)
+
+    count = len(value) // METADATA_BUCKET_SIZE + 1
+    parts = [{} for i in range(count)]
+    for key, val in value.items():
+        parts[metadata_bucket(key, count)][key] = val
+    parts = [metadata_pack(i) for i in parts]
+    offset = len(METADATA_BUCKETS) + 4 + 8 * count
+    table = []
+    for part in parts:
+        table.append(struct.pack('>II', offset, len(part)))
+        offset += len(part)
+    head = METADATA_BUCKETS + struct.pack('>I', count) + b''.join(table)
+    return head + b''.join(parts)
+
+
+def metadata_loads(data):
+    """Binary record is found by the header, otherwise it's JSON."""
+    if data.startswith(METADATA_MAGIC):
+        return metadata_unpack(data[len(METADATA_MAGIC):])
+    elif data.startswith(METADATA_BUCKETS):
+        value = {}
+        for offset, length in metadata_offsets(data):
+            part = data[offset:offset + length]
+            value.update(metadata_unpack(part))
+        return value
+    return json.loads(data.decode())
+
+
+def metadata_bucket(key, count):
+    return zlib.crc32(str(key).encode()) % count
+
+
+def metadata_offsets(data):
+    """Offsets of buckets: [(offset, length), ...] or None."""
+    if not data.startswith(METADATA_BUCKETS):
+        return None
+    start = len(METADATA_BUCKETS)
+    count, = struct.unpack('>I', data[start:start + 4])
+    table = data[start + 4:start + 4 + 8 * count]
+    return [i for i in struct.iter_unpack('>II', table)]
+
+
+def metadata_message(data):
+    msg = message.new()
+    msg.set_type('application/octet-stream')
+    msg.add_header('Content-Transfer-Encoding', 'base64')
+    msg.set_payload(base64.encodebytes(data).decode())
+    return msg
+
+
+def metadata_root(value):
+    """Empty root container, items are put there after loading."""
+    if isinstance(value, (list, tuple)):
+        return [{} for i in value]
+    return {}
+
+
+def metadata_delta(value, old, depth, full=False):
+    """Delta of items changed since "old" was loaded.
+
+    It's None if changes are unknown or, without "full", if most of items
+    are changed, so the whole snapshot should be saved instead.
+    """
+    changes = metadata_changes(value, old, depth)
+    if changes is None:
+        return None
+    changed, rm = changes
+    if not full and len(changed) + len(rm) >= metadata_count(value, depth) / 2:
+        return None
+    return {'rm': [list(i) for i in rm], 'set': metadata_rows(value, changed)}
+
+
+def metadata_replay(value, deltas, depth):
+    """Apply deltas of the journal, their items aren't marked as changed."""
+    for delta in deltas:
+        value = metadata_apply(value, delta)
+        metadata_unmark(value, delta)
+    if deltas:
+        value = metadata_track(value, depth)
+    return value
+
+
+def metadata_fetch(uids, con):
+    """Records of the journal in order of uids, JSON ones are loaded too."""
+    res = con.fetch_iter(uids, 'BINARY.PEEK[1]')
+    res = sorted(res, key=lambda i: int(i[0]))
+    return [metadata_loads(rec['BINARY[1]']) for _, rec in res]
+
+
+@using(SYS)
+def metadata_buckets(name, uids, keys, con=None):
+    """Items by keys from the snapshot with buckets and deltas after it.
+
+    Only needed buckets are fetched, offsets of buckets and fetched ones
+    are cached. It's None if the whole record should be fetched instead.
+    """
+    def fetch(uid, fields):
+        return dict(con.fetch_iter([uid], '(%s)' % fields))[uid]
+
+    lazy_key = 'metadata:%s:lazy' % name
+    lazy = cache.get(lazy_key)
+    if not lazy or lazy['uid'] != uids[0]:
+        start = len(METADATA_BUCKETS) + 4
+        rec = fetch(uids[0], 'BINARY.PEEK[1]<0.%s>' % start)
+        head = rec['BINARY[1]<0>']
+        count = None
+        if head.startswith(METADATA_BUCKETS):
+            count, = struct.unpack('>I', head[-4:])
+        if count and count > 1:
+            fields = 'BINARY.PEEK[1]<%s.%s>' % (start, count * 8)
+            table = fetch(uids[0], fields)['BINARY[1]<%s>' % start]
+            offsets = metadata_offsets(head + table)
+        else:
+            # JSON or small record without buckets
+            offsets = None
+        lazy = {'uid': uids[0], 'offsets': offsets, 'buckets': {}}
+        lazy['deltas'] = {}
+        cache.set(lazy_key, lazy)
+
+    offsets = lazy['offsets']
+    if not offsets:
+        return None
+    buckets = lazy['buckets']
+    nums = {metadata_bucket(k, len(offsets)) for k in keys}
+    nums = nums.difference(buckets)
+    if len(nums) > len(offsets) / 2:
+        # the whole value is fetched faster
+        return None
+    if nums:
+        fields = ' '.join(
+            'BINARY.PEEK[1]<%s.%s>' % offsets[i] for i in sorted(nums)
+        )
+        rec = fetch(uids[0], fields)
+        for i in nums:
+            data = rec['BINARY[1]<%s>' % offsets[i][0]]
+            buckets[i] = metadata_unpack(data)
+
+    value = {}
+    for key in keys:
+        bucket = buckets[metadata_bucket(key, len(offsets))]
+        if key in bucket:
+            value[key] = bucket[key]
+    deltas = lazy['deltas']
+    fetch_uids = [i for i in uids[1:] if i not in deltas]
+    if fetch_uids:
+        res = con.fetch_iter(fetch_uids, 'BINARY.PEEK[1]')
+        for uid, rec in res:
+            deltas[uid] = metadata_loads(rec['BINARY[1]'])
+    for uid in uids[1:]:
+        delta = deltas[uid]
+        value = metadata_apply(value, {
+            'rm': [p for p in delta.get('rm', []) if p[0] in keys],
+            'set': [i for i in delta.get('set', []) if i[0][0] in keys]
+        })
+    cache.set(lazy_key, lazy)
+    return value
+
+
+def metadata_index_save(name, value, delta, depth):
+    """Items are saved to the SQLite index, returns the new version.
+
+    Without "delta" all items of the value replace the previous ones.
+    """
+    root = None
+    if delta is None:
+        root = metadata_root(value)
+        delta = {'set': metadata_rows(value, metadata_paths(value, depth))}
+    return index.save(name, delta, root)
+
+
+def metadata_index_load(name):
+    """Value with all items from the SQLite index."""
+    root, rows = index.load(name)
+    return metadata_apply(root, {'set': rows})
+
+
+# metadata records waiting for the end of transaction by greenlet
+metadata_batches = {}
 
 
-def metadata(name, default):
+def metadata_batch():
+    return metadata_batches.get(getcurrent())
+
+
+def metadata_pending():
+    """Names of metadata written in the current transaction."""
+    batch = metadata_batch()
+    if not batch:
+        return []
+    return list(batch.get('values', {})) + list(batch['states'])
+
+
+@contextmanager
+def metadata_transaction():
+    """Metadata written inside is saved at the end by one MULTIAPPEND.
+
+    Readers see either all records of the transaction or none of them.
+    Written records are locked only while they are saved at the end.
+    Nested transactions are joined to the outer one.
+    """
+    if metadata_batch() is not None:
+        yield
+        return
+
+    current = getcurrent()
+    batch = metadata_batches[current] = {
+        'values': {}, 'records': [], 'states': {}
+    }
+    try:
+        yield
+        metadata_commit(batch)
+    finally:
+        metadata_batches.pop(current, None)
+
+
+def metadata_commit(batch):
+    # written values are saved like outside of the transaction now
+    values = batch.pop('values')
+    with ExitStack() as locks:
+        for name in sorted(values):
+            locks.enter_context(lock.user_scope(name))
+        for save, val in values.values():
+            save(val)
+        if batch['records']:
+            metadata_append(batch)
+
+
+@fn_time
+@using(SYS)
+def metadata_append(batch, con=None):
+    msgs = []
+    for name, data, flags in batch['records']:
+        msg = metadata_message(data)
+        msg.add_header('Subject', name)
+        msgs.append((None, flags, msg.as_bytes()))
+    uids = imap.UidSet(con.multiappend(SYS, msgs))
+
+    latest = dict(zip((i[0] for i in batch['records']), uids))
+    for name, uid in latest.items():
+        state = (uid,) + batch['states'][name][1:]
+        cache.set('metadata:%s' % name, state)
+    log.debug('## metadata: %s records in one transaction', len(msgs))
+
+
+def metadata(name, default, depth=1, wrap=None, indexed=False):
+    """Value is saved as a snapshot with journal of deltas after it.
+
+    A delta keeps only changed items, items are found "depth" levels deep.
+    The new snapshot is saved after "METADATA_JOURNAL" deltas.
+    With "wrap" the loaded value is kept in memory as "wrap(value)".
+
+    With METADATA_DB items of "indexed" records are saved to the SQLite
+    index instead, only records built from "mlr/All" should be indexed.
+    Inside of "metadata_transaction" records are appended on commit.
+    """
     cache_key = 'metadata:%s' % name
 
-    @using(SYS, name='_con')
-    @lock.user_scope(name)
+    def use_index():
+        return indexed and index.enabled()
+
     def inner(*a, **kw):
-        con = kw.pop('_con')
         val = inner.fn(*a, **kw)
-        data = json.dumps(val, sort_keys=True)
-        msg = message.binary(data)
-        msg.add_header('Subject', name)
-        uidlatest = con.append(SYS, name, None, msg.as_bytes())
-        cache.set(cache_key, (uidlatest, val))
+        if wrap is not None and val is not None and not isinstance(val, wrap):
+            val = wrap(val)
+
+        batch = metadata_batch()
+        if batch is None:
+            with lock.user_scope(name):
+                return save(val)
+        elif 'values' in batch:
+            # saved by "metadata_commit" under the lock
+            batch['values'][name] = save, val
+            return val
+        return save(val)
+
+    def save(val):
+        # deltas of other processes are replayed before the diff
+        get()
+        state = get_state()
+        delta = None
+        to_index = use_index()
+        if state and (to_index or state[2] < conf['METADATA_JOURNAL']):
+            # only keys changed by the writer are compared
+            delta = metadata_delta(val, state[1], depth, full=to_index)
+
+        if delta is not None and not delta['rm'] and not delta['set']:
+            return val
+        elif to_index:
+            latest = metadata_index_save(name, val, delta, depth)
+            deltas = 0
+        elif delta is None:
+            data = metadata_dumps(val, buckets=depth == 1)
+            latest = append(data, name)
+            deltas = 0
+        else:
+            data = metadata_dumps(delta)
+            latest = append(data, '%s #delta' % name)
+            deltas = state[2] + 1
+        val = metadata_track(val, depth, clear=True)
+        set_state((latest, val, deltas))
         return val
 
+    def get_state():
+        batch = metadata_batch()
+        if batch and name in batch['states']:
+            return batch['states'][name]
+        return cache.get(cache_key)
+
+    def set_state(state):
+        batch = metadata_batch()
+        if batch and (state[0] is None or name in batch['states']):
+            # uid of the record is known after commit
+            batch['states'][name] = state
+        else:
+            cache.set(cache_key, state)
+
+    def append(data, flags):
+        batch = metadata_batch()
+        if batch is not None:
+            batch['records'].append((name, data, flags))
+            return None
+        return append_now(data, flags)
+
     @using(SYS)
-    def get(con=None):
-        uidlatest = metadata_uids(con=con).get(name)
-        if not uidlatest:
-            if isinstance(default, Exception):
-                raise default
-            return default()
+    def append_now(data, flags, con=None):
+        msg = metadata_message(data)
+        msg.add_header('Subject', name)
+        return con.append(SYS, flags, None, msg.as_bytes())
 
-        if cache.exists(cache_key):
-            uid, value = cache.get(cache_key)
-            if uid == uidlatest:
-                return value
+    def wrapped(value):
+        if value is None:
+            return value
+        elif wrap is not None and not isinstance(value, wrap):
+            value = wrap(value)
+        return metadata_track(value, depth, clear=True)
+
+    def get_default():
+        if isinstance(default, Exception):
+            raise default
+        return wrapped(default())
+
+    def get(con=None):
+        batch = metadata_batch()
+        if batch and name in batch.get('values', {}):
+            return batch['values'][name][1]
+        elif batch and name in batch['states']:
+            return batch['states'][name][1]
+        elif use_index():
+            return get_indexed()
+        return get_imap(con=con)
+
+    def get_indexed():
+        version = index.version(name)
+        if version is None:
+            if not metadata_uids().get(name):
+                return get_default()
+            # the record is copied from IMAP on the first access
+            value = get_imap()
+            version = metadata_index_save(name, value, None, depth)
+            cache.set(cache_key, (version, value, 0))
+            return value
 
-        def fetch():
-            res = con.fetch(uidlatest, 'BODY.PEEK[1]')
-            if res and res[0]:
-                data = json.loads(res[0][1].decode())
-                return data
-            return default()
+        state = cache.get(cache_key)
+        if state and state[0] == version:
+            return state[1]
+        value = wrapped(metadata_index_load(name))
+        cache.set(cache_key, (version, value, 0))
+        return value
 
-        value = fn_time(fetch, '%s.fetch' % inner.__name__)()
-        cache.set(cache_key, (uidlatest, value))
+    @using(SYS, fresh=True)
+    def get_imap(con=None):
+        uids = metadata_uids(con=con).get(name)
+        if not uids:
+            return get_default()
+
+        state = cache.get(cache_key)
+        if state and state[0] == uids[-1]:
+            return state[1]
+        elif state and state[0] in uids:
+            # only new deltas are fetched
+            _, value, _ = state
+            fetch_uids = uids[uids.index(state[0]) + 1:]
+        else:
+            value = None
+            fetch_uids = uids
+
+        fetch = fn_time(metadata_fetch, '%s.fetch' % inner.__name__)
+        records = fetch(fetch_uids, con)
+        if not records and value is None:
+            return get_default()
+        if value is None:
+            value = wrapped(records.pop(0))
+        value = metadata_replay(value, records, depth)
+
+        cache.set(cache_key, (uids[-1], value, len(uids) - 1))
         return value
 
+    def lookup(*keys):
+        """Items by keys: {key: value}, only needed buckets are fetched."""
+        def pick(value):
+            return {k: value[k] for k in keys if k in value}
+
+        if name in metadata_pending():
+            return pick(get())
+
+        state = cache.get(cache_key)
+        if use_index():
+            version = index.version(name)
+            if version is None or depth != 1:
+                return pick(get())
+            elif state and state[0] == version:
+                return pick(state[1])
+            found = ((k, index.lookup(name, [k])) for k in keys)
+            return {k: v for k, v in found if v is not None}
+
+        uids = metadata_uids().get(name)
+        if not uids or depth != 1:
+            return pick(get())
+        elif state and state[0] == uids[-1]:
+            return pick(state[1])
+        value = metadata_buckets(name, uids, keys)
+        return pick(get()) if value is None else value
+
     def key(name, default=None):
-        return get().get(name, default)
+        return lookup(name).get(name, default)
 
     def wrapper(fn):
         inner_fn = ft.wraps(fn)(inner)
         inner_fn.fn = fn
         inner_fn.get = get
         inner_fn.key = key
+        inner_fn.lookup = lookup
         return inner_fn
     return wrapper
 
 
-def metakey(metavalue, name, default=None):
-    @lock.user_scope('%s:%s' % (metavalue.__name__, name))
-    def inner(*a, **kw):
-        val = inner.fn(*a, **kw)
-        metavalue({name: val})
-        return val
+def setting(name, default=None):
+    """Setting saved as its own metadata record "settings/<name>".
+
+    Until the first write the value is taken from the combined "settings"
+    record, where all settings were saved before.
+    """
+    record_name = 'settings/%s' % name
+
+    def initial():
+        return (data_settings_legacy() or {}).get(name)
 
-    def unset():
-        metavalue({name: None})
+    def wrapper(fn):
+        inner_fn = metadata(record_name, initial)(fn)
+        load = inner_fn.get
 
-    def get(default=default):
-        value = metavalue.key(name)
-        if value is not None:
+        def raw(value):
             return value
-        elif default and isinstance(default, Exception):
-            raise default
-        elif callable(default):
-            return default()
+
+        raw.__name__ = fn.__name__
+        save = metadata(record_name, initial)(raw)
+
+        def unset():
+            save(None)
+
+        def get(default=default):
+            value = load()
+            if value is not None:
+                return value
+            elif default and isinstance(default, Exception):
+                raise default
+            elif callable(default):
+                return default()
+            else:
+                return default
+
+        def key(name, default=None):
+            return get().get(name, default)
+
+        inner_fn.get = get
+        inner_fn.key = key
+        inner_fn.unset = unset
+        return inner_fn
+    return wrapper
+
+
+class Shards(MutableMapping):
+    """Dict keyed by uids, shards are loaded on first access."""
+    def __init__(self, name, nums, load):
+        self.name = name
+        self.nums = nums
+        self.load = load
+        self.loaded = {}
+
+    def shard(self, key, create=False):
+        try:
+            num = int(key) // SHARD_SIZE
+        except (TypeError, ValueError):
+            return None
+        shard = self.loaded.get(num)
+        if shard is None and (create or num in self.nums):
+            shard = self.loaded[num] = self.load(num)
+        return shard
+
+    def __getitem__(self, key):
+        shard = self.shard(key)
+        if shard is None:
+            raise KeyError(key)
+        return shard[key]
+
+    def field(self, key, name):
+        """One field of the item, see "Msgs.field"."""
+        shard = self.shard(key)
+        if shard is None:
+            raise KeyError(key)
+        elif hasattr(shard, 'field'):
+            return shard.field(key, name)
+        return shard[key][name]
+
+    def __setitem__(self, key, value):
+        self.shard(key, create=True)[key] = value
+
+    def __delitem__(self, key):
+        shard = self.shard(key)
+        if shard is None:
+            raise KeyError(key)
+        del shard[key]
+
+    def __contains__(self, key):
+        shard = self.shard(key)
+        return shard is not None and key in shard
+
+    def __iter__(self):
+        for num in sorted(self.nums.union(self.loaded)):
+            if num not in self.loaded:
+                self.loaded[num] = self.load(num)
+            yield from self.loaded[num]
+
+    def __len__(self):
+        return sum(1 for i in self)
+
+    def __repr__(self):
+        return 'Shards(%r, %s loaded)' % (self.name, len(self.loaded))
+
+
+MISSING = object()
+
+
+class Msgs(MutableMapping):
+    """Compact table of messages: {uid: {"arrived": ..., "msgid": ...}}.
+
+    Numbers are kept in arrays sorted by uid, strings are interned and
+    equal senders are shared. Records which don't fit are kept as is.
+    Changed uids are kept like in "Tracked".
+    """
+    fields = {
+        'arrived', 'draft_id', 'msgid', 'origin_uid', 'from', 'parent', 'refs'
+    }
+
+    def __init__(self, items=()):
+        self.uids = array('q')
+        self.arrived = array('q')
+        self.origin_uids = array('q')
+        self.msgids = []
+        self.parents = []
+        self.draft_ids = []
+        self.senders = []
+        self.refs = []
+        self.addrs = {}
+        self.other = {}
+        self.changed = set()
+        items = items.items() if isinstance(items, Mapping) else items
+        for uid, msg in items:
+            self[uid] = msg
+        self.changed.clear()
+
+    def index(self, uid):
+        try:
+            num = int(uid)
+        except (TypeError, ValueError):
+            return None
+        i = bisect.bisect_left(self.uids, num)
+        if i < len(self.uids) and self.uids[i] == num:
+            return i
+        return None
+
+    def fits(self, uid, msg):
+        return (
+            isinstance(uid, str) and uid.isdigit() and
+            self.fields.issuperset(msg) and
+            isinstance(msg.get('arrived'), int) and
+            isinstance(msg.get('msgid'), str) and
+            str(msg.get('origin_uid')).isdigit() and
+            isinstance(msg.get('from', {}), dict) and
+            isinstance(msg.get('refs', []), list)
+        )
+
+    def sender(self, addr):
+        if addr is MISSING:
+            return addr
+        key = json.dumps(addr, sort_keys=True)
+        return self.addrs.setdefault(key, addr.copy())
+
+    def intern(self, value):
+        return sys.intern(value) if isinstance(value, str) else value
+
+    def field(self, uid, name):
+        """One field without building the whole record."""
+        i = self.index(uid)
+        if i is None:
+            return self.other[uid][name]
+        elif name == 'arrived':
+            return self.arrived[i]
+        elif name == 'origin_uid':
+            return str(self.origin_uids[i])
+        elif name == 'msgid':
+            return self.msgids[i]
+        elif name == 'refs' and self.refs[i] is not MISSING:
+            return list(self.refs[i])
+        return self[uid][name]
+
+    def __getitem__(self, uid):
+        i = self.index(uid)
+        if i is None:
+            return self.other[uid]
+
+        msg = {
+            'arrived': self.arrived[i],
+            'msgid': self.msgids[i],
+            'origin_uid': str(self.origin_uids[i]),
+        }
+        if self.parents[i] is not MISSING:
+            msg['parent'] = self.parents[i]
+        if self.draft_ids[i] is not MISSING:
+            msg['draft_id'] = self.draft_ids[i]
+        if self.senders[i] is not MISSING:
+            msg['from'] = self.senders[i].copy()
+        if self.refs[i] is not MISSING:
+            msg['refs'] = list(self.refs[i])
+        return msg
+
+    def __setitem__(self, uid, msg):
+        self.changed.add(uid)
+        if not self.fits(uid, msg):
+            if self.index(uid) is not None:
+                del self[uid]
+            self.other[uid] = msg
+            return
+
+        self.other.pop(uid, None)
+        row = (
+            int(msg['arrived']),
+            int(msg['origin_uid']),
+            self.intern(msg['msgid']),
+            self.intern(msg.get('parent', MISSING)),
+            self.intern(msg.get('draft_id', MISSING)),
+            self.sender(msg.get('from', MISSING)),
+            tuple(map(self.intern, msg['refs'])) if 'refs' in msg else MISSING,
+        )
+        columns = (
+            self.arrived, self.origin_uids, self.msgids,
+            self.parents, self.draft_ids, self.senders, self.refs,
+        )
+        i = self.index(uid)
+        if i is None:
+            i = bisect.bisect_left(self.uids, int(uid))
+            self.uids.insert(i, int(uid))
+            for column, value in zip(columns, row):
+                column.insert(i, value)
+        else:
+            for column, value in zip(columns, row):
+                column[i] = value
+
+    def __delitem__(self, uid):
+        i = self.index(uid)
+        if i is None:
+            del self.other[uid]
+            self.changed.add(uid)
+            return
+
+        self.changed.add(uid)
+        columns = (
+            self.uids, self.arrived, self.origin_uids, self.msgids,
+            self.parents, self.draft_ids, self.senders, self.refs,
+        )
+        for column in columns:
+            del column[i]
+
+    def __iter__(self):
+        for uid in self.uids:
+            yield str(uid)
+        yield from list(self.other)
+
+    def __len__(self):
+        return len(self.uids) + len(self.other)
+
+    def __sizeof__(self):
+        columns = (
+            self.uids, self.arrived, self.origin_uids, self.msgids,
+            self.parents, self.draft_ids, self.senders, self.refs,
+        )
+        size = object.__sizeof__(self) + sum(map(sys.getsizeof, columns))
+        size += sum(map(sys.getsizeof, set(self.msgids + self.parents)))
+        size += sum(map(sys.getsizeof, self.addrs.values()))
+        size += sum(map(sys.getsizeof, self.refs))
+        return size + sys.getsizeof(self.other)
+
+    def __repr__(self):
+        return 'Msgs(%s)' % len(self)
+
+
+def sharded(name, legacy=None, wrap=None):
+    """Dict of uids saved as "name/<num>" records by SHARD_SIZE uids.
+
+    Only loaded shards are saved, unchanged ones are skipped by "metadata".
+    """
+    records = {}
+
+    def record(num):
+        if num not in records:
+            def shard(value):
+                return value
+            shard.__name__ = 'data_%s_%s' % (name, num)
+            key = '%s/%s' % (name, num)
+            records[num] = metadata(key, dict, wrap=wrap, indexed=True)(shard)
+        return records[num]
+
+    def saved():
+        prefix = '%s/' % name
+
+        def shards(names):
+            return {
+                int(i[len(prefix):]) for i in names if i.startswith(prefix)
+            }
+
+        indexed = index.enabled()
+        found = shards(index.names() if indexed else metadata_uids())
+        if not found and indexed:
+            # shards aren't copied from IMAP to the index yet
+            found = shards(metadata_uids())
+        return found | shards(metadata_pending())
+
+    def nums():
+        found = saved()
+        if not found and legacy:
+            value = legacy()
+            if value:
+                log.info('## split %r into shards', name)
+                save(value)
+                found = saved()
+        return found
+
+    def load(num):
+        return record(num).get()
+
+    def save(value):
+        if isinstance(value, Shards):
+            shards = value.loaded
         else:
-            return default
+            # shards without items are saved empty
+            shards = {num: {} for num in saved()}
+            for key, val in value.items():
+                shards.setdefault(int(key) // SHARD_SIZE, {})[key] = val
+        for num, shard in shards.items():
+            record(num)(shard)
 
-    def key(name, default=None):
-        return get().get(name, default)
+    def inner(*a, **kw):
+        value = inner.fn(*a, **kw)
+        save(value)
+        return value
+
+    def get():
+        return Shards(name, nums(), load)
+
+    def lookup(*keys):
+        found = nums()
+        groups = {}
+        for key in keys:
+            try:
+                num = int(key) // SHARD_SIZE
+            except (TypeError, ValueError):
+                continue
+            if num in found:
+                groups.setdefault(num, []).append(key)
+
+        value = {}
+        for num, few in groups.items():
+            value.update(record(num).lookup(*few))
+        return value
 
     def wrapper(fn):
         inner_fn = ft.wraps(fn)(inner)
         inner_fn.fn = fn
         inner_fn.get = get
-        inner_fn.key = key
-        inner_fn.unset = unset
+        inner_fn.lookup = lookup
         return inner_fn
     return wrapper
 
 
-@metadata('settings', lambda: {})
-def data_settings(update=None):
-    """All persistent stuff saved under the one metadata row."""
-    settings = data_settings.get()
-    settings.update(update)
-    return settings
+def metadata_legacy(name, index=None):
+    """Reader of a record saved before sharding."""
+    def legacy(value):
+        return value
 
+    legacy.__name__ = 'data_%s' % name
+    record = metadata(name, lambda: None)(legacy)
 
-setting = ft.partial(metakey, data_settings)
+    def get():
+        value = record.get()
+        return value if value is None or index is None else value[index]
+    return get
+
+
+# all settings were saved in one record before
+data_settings_legacy = metadata_legacy('settings')
 
 
 @setting('uidnext')
@@ -187,6 +1186,20 @@ def data_links(links):
     return links
 
 
+@setting('modseq')
+def data_modseq(value):
+    """Summaries are synced with flags up to: [uidvalidity, modseq]."""
+    return value
+
+
+@metadata('linkids', lambda: {
+    mid: link for link in data_links.get() for mid in link
+}, indexed=True)
+def data_linkids(linkids):
+    """Links by message-ids: {msgid: [msgid, ...]}."""
+    return linkids
+
+
 @setting('drafts', lambda: {})
 def data_drafts(update):
     data = data_drafts.get()
@@ -262,26 +1275,23 @@ def get_tag(name, *, tags=None):
 @using()
 @using(SYS, name=None, parent=True)
 def tags_info(con=None):
-    def query(tag):
-        if tag.startswith('\\'):
-            return tag[1:]
-        return 'keyword %s' % tag
-
     thrids, thrs = data_threads.get()
-    unread_uids = set(con.search('(UNSEEN UNKEYWORD #trash UNKEYWORD #spam)'))
     special = {
         '\\Seen', '\\Deleted', '\\Answered', '\\Flagged', '\\Draft',
         '#trash', '#spam', '#sent', '#err'
     }
+    flags = [tag for tag in con.flags if tag not in special]
+    found = con.pipeline(
+        [('SEARCH', '(UNSEEN UNKEYWORD #trash UNKEYWORD #spam)')] +
+        [('SEARCH', flag_query(tag)) for tag in flags]
+    )
+    unread_uids = set(found.pop(0))
     tags = {
         '#unread': {'unread': len(unread_uids)},
         '#inbox': {'pinned': 1, 'unread': 0}
     }
     tags_info = data_tags.get()
-    for tag in con.flags:
-        if tag in special:
-            continue
-        uids = con.search(query(tag))
+    for tag, uids in zip(flags, found):
         if not uids:
             continue
         tags.setdefault(tag, {'unread': 0})
@@ -355,43 +1365,145 @@ def sieve_scripts(name=None):
     return data[name] if name else data
 
 
-@metadata('uidpairs', lambda: {})
+@metadata('uidpairs', lambda: {}, indexed=True)
 def data_uidpairs(pairs):
     return pairs
 
 
-@metadata('addresses', lambda: ({}, {}))
+@metadata('addresses', lambda: ({}, {}), depth=2, indexed=True)
 def data_addresses(addrs_from, addrs_to):
     return [addrs_from, addrs_to]
 
 
-@metadata('msgs', lambda: {})
+@sharded('msgs', metadata_legacy('msgs'), wrap=Msgs)
 def data_msgs(msgs):
     return msgs
 
 
-@metadata('msgids', lambda: {})
+@metadata('msgids', lambda: {}, indexed=True)
 def data_msgids(mids):
     return mids
 
 
+@metadata('refs', lambda: {}, indexed=True)
+def data_refs(refs):
+    """Messages by ids from "References": {id: [uid, ...]}."""
+    return refs
+
+
+@metadata('summaries', lambda: {}, indexed=True)
+def data_summaries(summaries):
+    """Threads for "thrs_info": {thrid: {view: summary}}.
+
+    Views are "all" (without trash and spam), "#trash" and "#spam".
+    """
+    return summaries
+
+
+def thread_summary(uids, msgs, flags):
+    """Summaries of the thread by views, see "data_summaries"."""
+    views = {}
+    for uid in uids:
+        msg_flags = set(flags.get(uid, []))
+        for view in ('all', '#trash', '#spam'):
+            if view == 'all':
+                if {'#trash', '#spam'}.intersection(msg_flags):
+                    continue
+            elif view not in msg_flags:
+                continue
+
+            info = msgs[uid]
+            summary = views.setdefault(view, {
+                'flags': [], 'unread': 0, 'addrs': [], 'draft_id': None
+            })
+            summary['uid'] = uid
+            summary['addrs'].append(info.get('from'))
+            if '\\Seen' not in msg_flags:
+                summary['unread'] += 1
+            if '\\Draft' in msg_flags:
+                summary['draft_id'] = info['draft_id']
+            if not msg_flags.issubset(summary['flags']):
+                summary['flags'] = sorted(msg_flags.union(summary['flags']))
+    return views
+
+
+def thread_summaries(thrids, thrs, con):
+    """Summaries of threads with flags fetched from "mlr/All"."""
+    uids = list(it.chain(*(thrs[i] for i in thrids)))
+    if not uids:
+        return {}
+    res = con.fetch_iter(uids, '(UID FLAGS)')
+    flags = {uid: sorted(rec.flags) for uid, rec in res}
+    msgs = data_msgs.get()
+    return {i: thread_summary(thrs[i], msgs, flags) for i in thrids}
+
+
+@using()
+def update_summaries(thrids, thrs=None, con=None):
+    """Summaries of threads are built again, the gone ones are removed."""
+    thrids = set(thrids)
+    if not thrids:
+        return
+    if thrs is None:
+        thrs = data_threads.get()[1]
+
+    summaries = data_summaries.get()
+    for thrid in thrids.difference(thrs):
+        summaries.pop(thrid, None)
+    summaries.update(thread_summaries(thrids.intersection(thrs), thrs, con))
+    data_summaries(summaries)
+
+
+@fn_time
+@using()
+@using(SYS, name=None, parent=True)
+def sync_summaries(wait=0, con=None):
+    """Flags changed in "mlr/All" since the last sync go to summaries.
+
+    It's skipped if another sync is running, changes are picked up later.
+    """
+    try:
+        # building all summaries takes a while, so the holder isn't killed
+        with lock.user_scope('sync_summaries', wait=wait, timeout=3600):
+            _sync_summaries(con)
+    except lock.Error as e:
+        log.info('## summaries are not synced: %s', e)
+
+
+@metadata_transaction()
+def _sync_summaries(con):
+    # changes after this point are picked up by the next sync
+    res = con.status(ALL, '(HIGHESTMODSEQ)')
+    modseq = int(re.search(r'HIGHESTMODSEQ (\d+)', res[0].decode()).group(1))
+    state = data_modseq.get()
+    thrids, thrs = data_threads.get()
+    if state and state[0] == con.uidvalidity:
+        if state[1] >= modseq:
+            return
+        res, _ = con.fetch_changes('1:*', state[1])
+        changed = {thrids[rec.uid] for rec in res if rec.uid in thrids}
+    else:
+        log.info('## build all summaries')
+        changed = set(thrs).union(data_summaries.get())
+    update_summaries(changed, thrs, con=con)
+    data_modseq([con.uidvalidity, modseq])
+    log.info('## updated %s summaries', len(changed))
+
+
 def clean_threads(uids):
     thrids, thrs = data_threads.get()
+    threads = ThreadSet(thrids, thrs, data_msgs.get())
+    changed = {threads.thrids[i] for i in uids if i in threads.thrids}
     cleaned_uids = []
     cleaned = set()
     for uid in uids:
-        thrid = thrids.pop(uid, None)
-        thr = thrs.get(thrid)
-        if uid == thrid:
-            del thrs[uid]
+        thr = threads.remove(uid)
+        if thr:
             cleaned_uids.extend(thr)
             cleaned.add(uid)
-        elif thr:
-            thr.remove(uid)
-    for uid in cleaned_uids:
-        thrids.pop(uid, None)
 
     data_threads(thrids, thrs)
+    update_summaries(changed, thrs)
     log.info('## cleaned %s threads', len(cleaned))
     return cleaned_uids
 
@@ -400,28 +1512,44 @@ def clean_msgs(uids):
     msgs = data_msgs.get()
     uidpairs = data_uidpairs.get()
     msgids = data_msgids.get()
+    refs = data_refs.get()
+
+    def clean(index, key, uid):
+        ids = [i for i in index.get(key, []) if i != uid]
+        if ids:
+            index[key] = ids
+        else:
+            index.pop(key, None)
 
     for uid in uids:
         msg = msgs.pop(uid)
         uidpairs.pop(msg['origin_uid'], None)
-        mid = msg['msgid']
-        ids = msgids[mid]
-        if len(ids) == 1:
-            del msgids[mid]
-        else:
-            ids.remove(uid)
-            msgids[mid] = ids
+        clean(msgids, msg['msgid'], uid)
+        for ref in msg.get('refs', []):
+            clean(refs, ref, uid)
 
     data_msgs(msgs)
     data_uidpairs(uidpairs)
     data_msgids(msgids)
+    data_refs(refs)
     log.info('## cleaned %s messages' % len(uids))
 
 
+@fn_time
+def rebuild_metadata():
+    """Metadata of messages is built from scratch using "mlr/All"."""
+    data_threads({}, {})
+    data_summaries({})
+    update_metadata('1:*')
+    # all summaries are built here if they have never been synced
+    sync_summaries(wait=30)
+
+
 @fn_time
 @using(parent=True)
 @using(SYS, name=None, parent=True)
 @lock.user_scope('update_metadata')
+@metadata_transaction()
 def update_metadata(uids=None, clean=False, con=None):
     if clean:
         clean_msgs(uids)
@@ -434,11 +1562,13 @@ def update_metadata(uids=None, clean=False, con=None):
         addrs_from, addrs_to = {}, {}
         uidpairs = {}
         msgids = {}
+        refs = {}
     else:
         msgs = data_msgs.get()
         addrs_from, addrs_to = data_addresses.get()
         uidpairs = data_uidpairs.get()
         msgids = data_msgids.get()
+        refs = data_refs.get()
         thrids, thrs = data_threads.get()
 
         if uids is None:
@@ -457,49 +1587,66 @@ def update_metadata(uids=None, clean=False, con=None):
                 addr['time'] = meta['date']
                 store[a] = addr
             elif store[a]['time'] < meta['date']:
-                store[a]['time'] = meta['date']
+                store[a] = dict(store[a], time=meta['date'])
 
-    res = con.fetch(imap.Uids(uids), '(FLAGS BINARY.PEEK[1])')
-    for i in range(0, len(res), 2):
-        pattern = r'UID (\d+) FLAGS \(([^)]*)\)'
-        uid, flags = re.search(pattern, res[i][0].decode()).groups()
-        info = json.loads(res[i][1])
+    def add_uid(index, key, uid):
+        ids = index.get(key, [])
+        if uid not in ids:
+            ids.append(uid)
+            if len(ids) > 1:
+                ids = sorted(ids, key=lambda i: int(i))
+            index[key] = ids
+
+    res = con.fetch_iter(
+        imap.Uids(uids),
+        '(FLAGS BINARY.PEEK[1] BODY.PEEK[HEADER.FIELDS (References)])'
+    )
+    updated = []
+    for uid, rec in res:
+        msg_flags = rec.flags
+        info = json.loads(rec['BINARY[1]'])
         keys = ('arrived', 'draft_id', 'msgid', 'origin_uid', 'from', 'parent')
         small_info = {k: v for k, v in info.items() if k in keys}
-        msgs[uid] = small_info
         uidpairs[info['origin_uid']] = uid
 
         # message-ids
-        mid = info['msgid']
-        ids = msgids.get(mid, [])
-        if uid not in ids:
-            ids.append(uid)
-            if len(ids) > 1:
-                ids = sorted(ids, key=lambda i: int(i))
-            msgids[mid] = ids
+        add_uid(msgids, info['msgid'], uid)
+
+        # references with ids from "X-Thread-ID" for threading
+        msg_refs = rec['BODY[HEADER.FIELDS (REFERENCES)]'].decode()
+        msg_refs = re.sub(r'^References: ?', '', msg_refs).split()
+        small_info['refs'] = msg_refs
+        for ref in msg_refs:
+            add_uid(refs, ref, uid)
 
         # addresses
-        if {'#sent', '\\Draft'}.intersection(flags.split()):
+        if {'#sent', '\\Draft'}.intersection(msg_flags):
             fill_addrs(addrs_from, info, ('from',))
             fill_addrs(addrs_to, info, ('from', 'to', 'cc'))
+        # after addresses, as "time" is set there for "from" of own messages
+        msgs[uid] = small_info
+        updated.append(uid)
 
     data_msgs(msgs)
     data_uidpairs(uidpairs)
     data_msgids(msgids)
+    data_refs(refs)
     data_addresses(addrs_from, addrs_to)
-    update_threads(uids)
+    update_threads(updated)
     return msgs
 
 
 def pair_origin_uids(uids, uidpairs=None):
+    uids = list(uids)
     if uidpairs is None:
-        uidpairs = data_uidpairs.get()
+        uidpairs = data_uidpairs.lookup(*uids)
     return tuple(uidpairs[i] for i in uids if i in uidpairs)
 
 
 def pair_parsed_uids(uids, msgs=None):
+    uids = list(uids)
     if msgs is None:
-        msgs = data_msgs.get()
+        msgs = data_msgs.lookup(*uids)
     return tuple(msgs[i]['origin_uid'] for i in uids if i in msgs)
 
 
@@ -509,17 +1656,24 @@ def pair_parsed_uids(uids, msgs=None):
 @lock.user_scope('link_threads')
 def link_threads(uids, unlink=False, con=None):
     thrids, thrs = data_threads.get()
-    all_uids = set(sum((thrs[thrids[uid]] for uid in uids), []))
+    all_uids = set(it.chain(*(thrs[thrids[uid]] for uid in uids)))
 
     msgs = data_msgs.get()
-    links = data_links.get()
+    linkids = data_linkids.get()
 
-    link = set(msgs[uid]['msgid'] for uid in all_uids)
-    links = [l for l in links if not link.intersection(l)]
+    link = set(msgs.field(uid, 'msgid') for uid in all_uids)
+    old = {tuple(linkids[mid]) for mid in link if mid in linkids}
+    for mid in it.chain(*old):
+        del linkids[mid]
+    links = data_links.get()
+    if old:
+        links = [l for l in links if tuple(l) not in old]
     if not unlink:
         links.append(sorted(link))
+        linkids.update((mid, links[-1]) for mid in link)
 
     data_links(links)
+    data_linkids(linkids)
     clean_threads(all_uids)
     update_threads(all_uids)
     return sorted(all_uids)
@@ -530,21 +1684,21 @@ def unlink_threads(uids):
 
 
 @using(SRC, reuse=False)
-def parse_msgs(uids, con=None):
-    res = con.fetch(uids.str, '(UID INTERNALDATE FLAGS BODY.PEEK[])')
+@using(None, name='con_all', readonly=False, reuse=False)
+def parse_msgs(uids, con=None, con_all=None):
+    res = con.fetch_iter(uids.str, '(UID INTERNALDATE FLAGS BODY.PEEK[])')
 
     def msgs():
-        for i in range(0, len(res), 2):
-            line, body = res[i]
-            pattern = r'UID (\d+) INTERNALDATE ("[^"]+") FLAGS \(([^)]*)\)'
-            uid, time, flags = re.search(pattern, line.decode()).groups()
-            flags = flags.split()
-            msg_obj, marks = message.parsed(body, uid, time, flags)
+        for uid, rec in res:
+            time = '"%s"' % rec.internaldate
+            flags = list(rec.flags)
+            msg_obj, marks = message.parsed(rec['BODY[]'], uid, time, flags)
             flags += marks
             msg = msg_obj.as_bytes()
             yield time, ' '.join(flags), msg
 
-    return con.multiappend(ALL, list(msgs()))
+    # messages are appended while they are still being fetched
+    return con_all.multiappend(ALL, msgs())
 
 
 @fn_time
@@ -565,7 +1719,7 @@ def parse(criteria=None, con=None, **opts):
             uidnext = uidmax + 1
         criteria = 'UID %s:*' % uidnext
 
-    con.select(SRC)
+    con.select(SRC, fresh=True)
     uids = con.sort('(ARRIVAL)', criteria)
     uids = [i for i in uids if i and int(i) >= uidnext]
     if not uids:
@@ -578,7 +1732,7 @@ def parse(criteria=None, con=None, **opts):
     sieve_run('UID %s' % ','.join(uids), sieve_scripts('auto'))
 
     log.info('## criteria: %r; %s uids', criteria, len(uids))
-    count = con.select(ALL)[0].decode()
+    count = con.select(ALL, fresh=True)[0].decode()
     if count != '0':
         if criteria.lower() == 'all':
             puids = con.search('all')
@@ -601,11 +1755,203 @@ def parse(criteria=None, con=None, **opts):
     update_metadata(puids)
 
 
-@metadata('threads', lambda: [{}, {}])
+@sharded('thrids', metadata_legacy('threads', 0))
+def data_thrids(thrids):
+    return thrids
+
+
+@sharded('thrs', metadata_legacy('threads', 1))
+def data_thrs(thrs):
+    return thrs
+
+
+class ThreadIds(MutableMapping):
+    """Thread of every uid: {uid: thrid}, it's a disjoint-set forest.
+
+    Saved value can be an older thrid of the same thread, it's resolved
+    to the latest one by following parents. Reads don't change anything,
+    because "raw" can be cached shards, paths are halved only by "find"
+    while threads are updated.
+    """
+    def __init__(self, raw):
+        self.raw = raw
+
+    def __getitem__(self, uid):
+        raw = self.raw
+        parent = raw[uid]
+        while True:
+            grand = raw.get(parent, parent)
+            if grand == parent:
+                return parent
+            parent = grand
+
+    def find(self, uid):
+        """Like "thrids[uid]", but paths are halved on the way."""
+        raw = self.raw
+        parent = raw[uid]
+        while True:
+            grand = raw.get(parent, parent)
+            if grand == parent:
+                return parent
+            raw[uid] = grand
+            uid, parent = grand, raw.get(grand, grand)
+
+    def __setitem__(self, uid, thrid):
+        self.raw[uid] = thrid
+
+    def __delitem__(self, uid):
+        del self.raw[uid]
+
+    def __contains__(self, uid):
+        return uid in self.raw
+
+    def __iter__(self):
+        return iter(self.raw)
+
+    def __len__(self):
+        return len(self.raw)
+
+
+class ThreadSet:
+    """Threads as a disjoint-set, uids of a thread are sorted by arrival.
+
+    Merging touches only uids of smaller threads, the thrid is the latest
+    uid, so the previous thrids just point to the new one.
+    """
+    def __init__(self, thrids, thrs, msgs):
+        if not isinstance(thrids, ThreadIds):
+            thrids = ThreadIds(thrids)
+        self.thrids = thrids
+        self.thrs = thrs
+        self.msgs = msgs
+        self.keys = {}
+
+    def key(self, uid):
+        key = self.keys.get(uid)
+        if key is None:
+            key = (self.msgs.field(uid, 'arrived'), int(uid))
+            self.keys[uid] = key
+        return key
+
+    def insort(self, thr, uid):
+        key = self.key(uid)
+        lo, hi = 0, len(thr)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key(thr[mid]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        thr.insert(lo, uid)
+
+    def union(self, uids):
+        """Merge threads of uids (new uids are added), returns thrid."""
+        thrids, thrs = self.thrids, self.thrs
+        uids = list(dict.fromkeys(uids))
+        found = {i: thrids.find(i) for i in uids if i in thrids}
+        roots = sorted(
+            {r for r in found.values() if r in thrs},
+            key=lambda r: len(thrs[r])
+        )
+        thr = thrs[roots[-1]] if roots else []
+        smaller = (thrs[r] for r in roots[:-1])
+        new = [i for i in uids if found.get(i) not in roots]
+        for uid in it.chain(*smaller, new):
+            self.insort(thr, uid)
+
+        thrid = thr[-1]
+        for uid in it.chain(roots, new, [thrid]):
+            thrids[uid] = thrid
+        for root in roots:
+            if root != thrid:
+                del thrs[root]
+        thrs[thrid] = thr
+        return thrid
+
+    def remove(self, uid):
+        """Remove uid, the whole thread is removed with its thrid.
+
+        Returns uids of the removed thread.
+        """
+        thrids, thrs = self.thrids, self.thrs
+        if uid not in thrids:
+            return []
+
+        thrid = thrids.find(uid)
+        if uid == thrid:
+            thr = thrs.pop(thrid, [])
+            for i in thr + [uid]:
+                thrids.raw.pop(i, None)
+            return thr
+
+        thr = thrs.get(thrid)
+        if thr:
+            # other uids could point to the removed one
+            for i in thr:
+                thrids[i] = thrid
+            thr.remove(uid)
+            thrs[thrid] = thr
+        thrids.raw.pop(uid, None)
+        return []
+
+
+def thread_refs(items):
+    """Threads by "References" like THREAD=REFS: [[uid, ...], ...].
+
+    Messages are linked by ids as in RFC 5256 (without subjects),
+    "items" are (uid, msgid, refs) in order of uids.
+    """
+    parent = {}
+
+    def is_ancestor(mid, of):
+        while of is not None:
+            if of == mid:
+                return True
+            of = parent.get(of)
+        return False
+
+    msgids = {}
+    for uid, mid, refs in items:
+        if mid in msgids:
+            # the same message-id is used by a few messages
+            mid = '%s %s' % (mid, uid)
+        msgids[mid] = uid
+
+        prev = None
+        for ref in refs:
+            # existing links are kept, loops are skipped
+            if prev and ref not in parent and not is_ancestor(ref, prev):
+                parent[ref] = prev
+            prev = ref
+        # the last reference is the parent of the message
+        parent.pop(mid, None)
+        if prev and not is_ancestor(mid, prev):
+            parent[mid] = prev
+
+    threads = {}
+    for mid, uid in msgids.items():
+        while mid in parent:
+            mid = parent[mid]
+        threads.setdefault(mid, []).append(uid)
+    return list(threads.values())
+
+
 def data_threads(thrids, thrs):
+    """Threads are two sharded dicts: uid -> thrid and thrid -> uids."""
+    if isinstance(thrids, ThreadIds):
+        thrids = thrids.raw
+    data_thrids(thrids)
+    data_thrs(thrs)
     return [thrids, thrs]
 
 
+def _data_threads_get():
+    return [ThreadIds(data_thrids.get()), data_thrs.get()]
+
+
+data_threads.get = _data_threads_get
+
+
 @using()
 @using(SYS, name=None, parent=True)
 @lock.user_scope('update_threads')
@@ -613,25 +1959,52 @@ def update_threads(uids, thrids=None, thrs=None, con=None):
     if thrids is None:
         thrids, thrs = data_threads.get()
 
-    if not isinstance(uids, str):
-        uids = ','.join(uids)
+    if isinstance(uids, str):
+        uids = con.search('UID %s' % uids)
 
-    orig_thrs = con.thread('REFS UTF-8 INTHREAD REFS UID %s' % uids)
-    if not orig_thrs:
+    msgs = data_msgs.get()
+    threads = ThreadSet(thrids, thrs, msgs)
+    uids = [i for i in uids if i in msgs]
+    if not uids:
         log.info('## no threads are updated')
         return
 
-    all_uids = set(orig_thrs.all_uids)
-
-    msgs = data_msgs.get()
-    mids = data_msgids.get()
+    def ids(uid):
+        msg = msgs[uid]
+        refs = msg.get('refs')
+        if refs is None:
+            # saved before "refs", "mlr metadata --rebuild" fixes it
+            refs = [msg['parent']] if msg.get('parent') else []
+        return msg['msgid'], refs
+
+    # like INTHREAD: messages sharing ids with uids and their threads
+    found = {i: ids(i) for i in uids}
+    shared = set(it.chain(*((m, *r) for m, r in found.values())))
+    related = it.chain(
+        *data_msgids.lookup(*shared).values(),
+        *data_refs.lookup(*shared).values(),
+    )
+    for uid in set(related).difference(found):
+        if uid in msgs:
+            found[uid] = ids(uid)
+    thrids = threads.thrids
+    changed = {thrids[i] for i in list(found) if i in thrids}
+    for thrid in changed:
+        for uid in thrs.get(thrid, []):
+            if uid not in found and uid in msgs:
+                found[uid] = ids(uid)
+
+    orig_thrs = thread_refs(
+        (uid, *found[uid]) for uid in sorted(found, key=int)
+    )
 
+    links = data_linkids.lookup(*(mid for mid, _ in found.values()))
+    links = {tuple(link) for link in links.values()}
+    mids = data_msgids.lookup(*it.chain(*links))
     all_links = []
     linked_uids = set()
-    for link in data_links.get():
+    for link in links:
         uids = sum((mids.get(mid, []) for mid in link), [])
-        if not all_uids.intersection(uids):
-            continue
         all_links.append(uids)
         linked_uids.update(uids)
 
@@ -639,25 +2012,12 @@ def update_threads(uids, thrids=None, thrs=None, con=None):
     for uids in orig_thrs:
         uids_set = set(uids)
         if uids_set.intersection(linked_uids):
-            uids = (list(l) for l in all_links if uids_set.intersection(l))
-            uids = sum(uids, [])
-            uids = uids + [uid for uid in uids_set if uid not in uids]
-
-        previous_thrids = set(thrids[i] for i in uids if thrids.get(i))
-        previous_uids = (thrs[uid] for uid in previous_thrids if thrs.get(uid))
-        previous_uids = sum(previous_uids, [])
-        uids = set(previous_uids).union(uids)
-        uids = sorted(uids, key=lambda i: msgs[i]['arrived'])
-        thrid = uids[-1]
-        for uid in uids:
-            thrids[uid] = thrid
-            if uid == thrid:
-                thrs[uid] = uids
-                updated.add(uid)
-            elif uid in thrs:
-                del thrs[uid]
+            links = (l for l in all_links if uids_set.intersection(l))
+            uids = list(it.chain(*links, uids))
+        updated.add(threads.union(uids))
 
     data_threads(thrids, thrs)
+    update_summaries(changed | updated, thrs)
     log.info('updated %s threads', len(updated))
 
 
@@ -676,11 +2036,16 @@ def msgs_flag(uids, old, new, con_src=None, con_all=None):
         if '\\Deleted' in add:
             con.expunge()
 
+    src_uids = pair_parsed_uids(uids)
     jobs = [
         spawn(store, con_all, uids),
-        spawn(store, con_src, pair_parsed_uids(uids))
+        spawn(store, con_src, src_uids)
     ]
     joinall(jobs, raise_error=True)
+    if src_uids and '\\Deleted' in set(new) - set(old):
+        for hook in expunge_hooks:
+            hook(src_uids)
+    sync_summaries()
 
 
 @using(SRC)
@@ -692,6 +2057,37 @@ def msgs_expunge(tag, con=None):
     update_metadata(parsed_uids, clean=True)
 
 
+@fn_time
+@using(SRC, name='con_src', readonly=False)
+@using(ALL, name='con_all', readonly=False)
+def origin_changes(flags, deleted, con_src=None, con_all=None):
+    """Apply changes of origin messages to both mailboxes.
+
+    "flags" is {(cmd, flag): origin uids}, "deleted" is origin uids.
+    """
+    uidpairs = data_uidpairs.get()
+    for con, pairs in ((con_src, None), (con_all, uidpairs)):
+        stores = []
+        for (cmd, flag), uids in sorted(flags.items()):
+            if pairs is not None:
+                uids = pair_origin_uids(uids, pairs)
+            stores += flag_stores(imap.UidSet(uids), cmd, flag)
+        if stores:
+            con.pipeline(stores)
+
+    if not deleted:
+        sync_summaries()
+        return
+    con_src.copy(deleted, DEL)
+    con_src.store(deleted, '+FLAGS.SILENT', '\\Deleted')
+    con_src.expunge()
+    parsed_uids = pair_origin_uids(deleted, uidpairs)
+    if parsed_uids:
+        con_all.store(parsed_uids, '+FLAGS.SILENT', '\\Deleted')
+        con_all.expunge()
+        update_metadata(parsed_uids, clean=True)
+
+
 @fn_time
 @using(SRC, name='con_src', readonly=False)
 @using(ALL, name='con_all', readonly=False)
@@ -699,6 +2095,15 @@ def clean_flags(flags, con_all=None, con_src=None):
     flags = ' '.join(flags)
     con_all.store('1:*', '-FLAGS.SILENT', flags)
     con_src.store('1:*', '-FLAGS.SILENT', flags)
+    sync_summaries()
+
+
+def flag_query(flag):
+    return flag[1:] if flag.startswith('\\') else 'keyword %s' % flag
+
+
+def flag_stores(uids, cmd, flag, batch=10000):
+    return [('STORE', str(few), cmd, flag) for few in uids.split(batch)]
 
 
 @fn_time
@@ -707,33 +2112,36 @@ def clean_flags(flags, con_all=None, con_src=None):
 @using(SYS, name=None, parent=True)
 def sync_flags_to_all(con_src=None, con_all=None):
     skip_flags = set(['#err'])
-    for flag in con_src.flags:
-        if flag in skip_flags:
-            continue
-        q = flag[1:] if flag.startswith('\\') else 'keyword %s' % flag
-        oids = con_src.search(q)
-        pairs = set(pair_origin_uids(oids))
-        pids = set(con_all.search(q))
-        con_all.store(pairs - pids, '+FLAGS.SILENT', flag)
-        con_all.store(pids - pairs, '-FLAGS.SILENT', flag)
+    flags = [f for f in con_src.flags if f not in skip_flags]
+    queries = [('SEARCH', flag_query(f)) for f in flags]
+    found = zip(flags, con_src.pipeline(queries), con_all.pipeline(queries))
+    stores = []
+    for flag, oids, pids in found:
+        pairs = imap.UidSet(pair_origin_uids(oids))
+        pids = imap.UidSet(pids)
+        stores += flag_stores(pairs - pids, '+FLAGS.SILENT', flag)
+        stores += flag_stores(pids - pairs, '-FLAGS.SILENT', flag)
+    con_all.pipeline(stores)
     rm_flags = set(con_all.flags) - set(con_src.flags) - skip_flags
     if rm_flags:
         con_all.store('1:*', '-FLAGS.SILENT', ' '.join(rm_flags))
+    sync_summaries()
 
 
 @fn_time
 @using(SRC, name='con_src', readonly=False)
 @using(ALL, name='con_all')
 def sync_flags_to_src(con_src=None, con_all=None):
-    for flag in con_all.flags:
-        if flag in ('#err'):
-            continue
-        q = flag[1:] if flag.startswith('\\') else 'keyword %s' % flag
-        pids = con_all.search(q)
-        pairs = set(pair_parsed_uids(pids))
-        oids = set(con_src.search(q))
-        con_src.store(pairs - oids, '+FLAGS.SILENT', flag)
-        con_src.store(oids - pairs, '-FLAGS.SILENT', flag)
+    flags = [f for f in con_all.flags if f not in ('#err')]
+    queries = [('SEARCH', flag_query(f)) for f in flags]
+    found = zip(flags, con_all.pipeline(queries), con_src.pipeline(queries))
+    stores = []
+    for flag, pids, oids in found:
+        pairs = imap.UidSet(pair_parsed_uids(pids))
+        oids = imap.UidSet(oids)
+        stores += flag_stores(pairs - oids, '+FLAGS.SILENT', flag)
+        stores += flag_stores(oids - pairs, '-FLAGS.SILENT', flag)
+    con_src.pipeline(stores)
     rm_flags = set(con_src.flags) - set(con_all.flags)
     if rm_flags:
         con_src.store('1:*', '-FLAGS.SILENT', ' '.join(rm_flags))
@@ -746,31 +2154,23 @@ def sync_flags(con=None, timeout=None):
     @using(ALL, name='con_all', readonly=False, reuse=False)
     def handler(res, con_src=None, con_all=None):
         modseq0 = modseq[0]
-        modseq_ = re.search(r'MODSEQ \((\d+)\)', res[0].decode()).group(1)
-        if int(modseq_) < int(modseq0):
+        modseq_ = imap.fetched(res[:1])[0].modseq
+        if modseq_ < modseq0:
             return
         modseq[0] = modseq_
-        res = con_src.fetch('1:*', '(UID FLAGS) (CHANGEDSINCE %s)' % modseq0)
-        src_flags = {}
-        for line in res:
-            val = re.search(r'UID (\d+) FLAGS \(([^)]*)\)', line.decode())
-            if not val:
-                continue
-            uid, flags = val.groups()
-            src_flags[uid] = flags
-
+        res = con_src.fetch_iter(
+            '1:*', '(UID FLAGS) (CHANGEDSINCE %s)' % modseq0
+        )
+        src_flags = {uid: rec.flags for uid, rec in res}
         if not src_flags:
             return
 
         actions = {}
         parsed = data_msgs.get()
         pids = pair_origin_uids(src_flags)
-        res = con_all.fetch(pids, '(UID FLAGS)')
-        for line in res:
-            pattern = r'UID (\d+) FLAGS \(([^)]*)\)'
-            uid, flags = re.search(pattern, line.decode()).groups()
-            flags = set(flags.split())
-            orig_flags = set(src_flags[parsed[uid]['origin_uid']].split())
+        for uid, rec in con_all.fetch_iter(pids, '(UID FLAGS)'):
+            flags = rec.flags
+            orig_flags = src_flags[parsed.field(uid, 'origin_uid')]
             val = sorted(orig_flags - flags)
             if val:
                 key = ('+FLAGS.SILENT', ' '.join(val))
@@ -784,12 +2184,14 @@ def sync_flags(con=None, timeout=None):
         log.debug('sync: MODSEQ=%s %s', modseq_, actions)
         for action, uids in actions.items():
             con_all.store(uids, *action)
+        if actions:
+            sync_summaries()
 
     res = con.status(SRC, '(UIDVALIDITY HIGHESTMODSEQ)')
     pair = re.search(r'UIDVALIDITY (\d+) HIGHESTMODSEQ (\d+)', res[0].decode())
     uidval, modseq = pair.groups()
     log.info('%s UIDVALIDITY=%s HIGHESTMODSEQ=%s', con, uidval, modseq)
-    modseq = [modseq]
+    modseq = [int(modseq)]
     con.select(SRC)
     con.idle(handler, 'FETCH', timeout=timeout)
 
@@ -798,8 +2200,9 @@ def sync_flags(con=None, timeout=None):
 @using(None)
 def raw_msg(uid, box, parsed=False, con=None):
     con.select(box)
-    res = con.fetch(uid, 'BODY.PEEK[]')
-    body = res[0][1] if res else None
+    fields = 'BODY.PEEK[]'
+    res = imap.fetched(con.fetch(uid, fields), uid, fields)
+    body = res[0]['BODY[]'] if res else None
     if body and parsed:
         body = email.message_from_bytes(body)
     return body
@@ -810,9 +2213,9 @@ def raw_msg(uid, box, parsed=False, con=None):
 def raw_part(uid, box, part, con=None):
     con.select(box)
     fields = '(BINARY.PEEK[{0}] BINARY.PEEK[{0}.mime])'.format(part)
-    res = con.fetch(uid, fields)
-    body = res[0][1]
-    mime = res[1][1]
+    rec = imap.fetched(con.fetch(uid, fields), uid, fields)[0]
+    body = rec['BINARY[%s]' % part]
+    mime = rec['BINARY[%s.MIME]' % part]
     content_type = email.message_from_bytes(mime).get_content_type()
     return body, content_type
 
@@ -820,16 +2223,12 @@ def raw_part(uid, box, part, con=None):
 @fn_time
 @using()
 def fetch_msg(uid, draft=False, con=None):
-    fields = (
-        '(FLAGS BINARY.PEEK[HEADER] BINARY.PEEK[1] BINARY.PEEK[2.%s])'
-        % ('2' if draft else '1')
-    )
-    res = con.fetch(uid, fields)
-    flags = re.search(r'FLAGS \(([^)]*)\)', res[0][0].decode()).group(1)
-    head = email.message_from_string(res[0][1].decode())
-    meta = json.loads(res[1][1].decode())
-    txt = res[2][1].decode()
-    return flags, head, meta, txt
+    txt = '2.%s' % ('2' if draft else '1')
+    fields = '(FLAGS BINARY.PEEK[HEADER] BINARY.PEEK[1] BINARY.PEEK[%s])' % txt
+    rec = imap.fetched(con.fetch(uid, fields), uid, fields)[0]
+    head = email.message_from_string(rec['BINARY[HEADER]'].decode())
+    meta = json.loads(rec['BINARY[1]'].decode())
+    return str(rec.flags), head, meta, rec['BINARY[%s]' % txt].decode()
 
 
 @fn_time
@@ -843,12 +2242,10 @@ def search_msgs(query, sort='(REVERSE ARRIVAL)', con=None):
 @fn_time
 @using()
 def msgs_info(uids, con=None):
-    res = con.fetch(uids, '(UID FLAGS BINARY.PEEK[1])')
-    for i in range(0, len(res), 2):
-        pattern = r'UID (\d+) FLAGS \(([^)]*)\)'
-        uid, flags = re.search(pattern, res[i][0].decode()).groups()
-        flags = flags.split()
-        yield uid, res[i][1], flags, None
+    # don't keep the connection busy while the caller handles results
+    res = list(con.fetch_iter(uids, '(UID FLAGS BINARY.PEEK[1])'))
+    for uid, rec in res:
+        yield uid, rec['BINARY[1]'], list(rec.flags), None
 
 
 @fn_time
@@ -856,9 +2253,8 @@ def msgs_info(uids, con=None):
 def msgs_body(uids, fix_privacy=False, con=None):
     msgs = data_msgs.get()
     drafts = data_drafts.get()
-    res = con.fetch(uids, '(UID BINARY.PEEK[2.1])')
-    for i in range(0, len(res), 2):
-        uid = res[i][0].decode().split()[2]
+    res = list(con.fetch_iter(uids, '(UID BINARY.PEEK[2.1])'))
+    for uid, rec in res:
         if uid not in msgs:
             continue
         draft_id = msgs[uid].get('draft_id')
@@ -869,7 +2265,7 @@ def msgs_body(uids, fix_privacy=False, con=None):
                 if p
             )
         else:
-            body = res[i][1].decode()
+            body = rec['BINARY[2.1]'].decode()
         body = html.fix_privacy(body, only_proxy=not fix_privacy)
         yield uid, body
 
@@ -893,7 +2289,9 @@ def search_thrs(query, con=None):
         msgs = data_msgs.get()
         thrids, thrs = data_threads.get()
         uids = set(thrids[uid] for uid in uids if uid in thrids)
-        uids = sorted(uids, key=lambda uid: msgs[uid]['arrived'], reverse=True)
+        uids = sorted(
+            uids, key=lambda uid: msgs.field(uid, 'arrived'), reverse=True
+        )
     log.debug('query: %r; threads: %s', query, len(uids))
     return uids
 
@@ -902,79 +2300,47 @@ def search_thrs(query, con=None):
 @using()
 @using(SYS, name=None, parent=True)
 def thrs_info(uids, tags=None, con=None):
-    special_tag = None
+    view = 'all'
     if not tags:
         pass
     elif '#trash' in tags:
-        special_tag = '#trash'
+        view = '#trash'
     elif '#spam' in tags:
-        special_tag = '#spam'
+        view = '#spam'
 
-    msgs = data_msgs.get()
     thrids, all_thrs = data_threads.get()
     uids = [thrids[uid] for uid in uids if uid in thrids]
     if not uids:
         return
 
-    all_uids = sum((all_thrs[uid] for uid in uids), [])
-    all_uids = imap.Uids(all_uids)
-
-    all_flags = {}
-    res = con.fetch(all_uids, '(UID FLAGS)')
-    for line in res:
-        pattern = r'UID (\d+) FLAGS \(([^)]*)\)'
-        uid, flags = re.search(pattern, line.decode()).groups()
-        all_flags[uid] = flags.split()
-
+    if data_modseq.get():
+        # changes skipped by a busy sync are picked up here
+        sync_summaries()
+    summaries = data_summaries.lookup(*uids)
+    missing = [i for i in uids if i not in summaries]
+    if missing:
+        # not built yet, "mlr metadata --rebuild" or "mlr sync" builds them
+        summaries.update(thread_summaries(missing, all_thrs, con))
     thrs = {}
     for thrid in uids:
-        thr = all_thrs[thrid]
-        thr_flags = []
-        addrs = []
-        unseen = False
-        draft_id = None
-        info = None
-        for uid in thr:
-            msg_flags = all_flags[uid]
-            if not special_tag and {'#trash', '#spam'}.intersection(msg_flags):
-                continue
-            elif special_tag and special_tag not in msg_flags:
-                continue
-            info = msgs[uid]
-            info['uid'] = uid
-            addrs.append(info.get('from'))
-            if '\\Seen' not in msg_flags:
-                unseen = True
-            if not msg_flags:
-                continue
-            if '\\Draft' in msg_flags:
-                draft_id = info['draft_id']
-            thr_flags.extend(msg_flags)
-        if not info:
-            continue
-        flags = list(set(' '.join(thr_flags).split()))
-        if unseen and '\\Seen' in flags:
-            flags.remove('\\Seen')
-        thrs[info['uid']] = {
-            'thrid': thrid,
-            'uids': thr,
-            'draft_id': draft_id,
-            'flags': flags,
-            'addrs': addrs
-        }
+        summary = summaries.get(thrid, {}).get(view)
+        if summary:
+            thrs[summary['uid']] = thrid, summary
 
     if not thrs:
         return
 
-    res = con.fetch(imap.Uids(thrs.keys()), 'BINARY.PEEK[1]')
-    for i in range(0, len(res), 2):
-        uid = res[i][0].decode().split()[2]
-        info = json.loads(res[i][1])
-        thr = thrs[uid]
-        info['uids'] = thr['uids']
-        if thr['draft_id']:
-            info['draft_id'] = thr['draft_id']
-        yield thr['thrid'], info, thr['flags'], thr['addrs']
+    res = list(con.fetch_iter(imap.Uids(list(thrs)), 'BINARY.PEEK[1]'))
+    for uid, rec in res:
+        info = json.loads(rec['BINARY[1]'])
+        thrid, summary = thrs[uid]
+        info['uids'] = all_thrs[thrid]
+        if summary['draft_id']:
+            info['draft_id'] = summary['draft_id']
+        flags = summary['flags']
+        if summary['unread']:
+            flags = [f for f in flags if f != '\\Seen']
+        yield thrid, info, flags, summary['addrs']
 
 
 @fn_time
@@ -41,10 +41,10 @@ def global_scope(target, timeout=180, wait=3, force=False):
             return
         return elapsed
 
-    locked = True
-    for i in range(wait):
+    # with "wait=0" it's checked only once
+    for i in range(wait + 1):
         locked = is_locked()
-        if not locked:
+        if not locked or i == wait:
             break
         sleep(1)
 
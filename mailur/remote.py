@@ -6,9 +6,33 @@ import smtplib
 
 from gevent import socket, ssl
 
-from . import fn_time, imap, imap_utf7, local, lock, log, message, schema
+from . import (
+    conf, fn_time, imap, imap_utf7, local, lock, log, message, schema
+)
 
 SKIP_DRAFTS = True
+# headers of imported messages used for deduplication
+ORIGIN_HEADERS = ('X-SHA256', 'X-GM-MSGID', 'X-Remote-UID')
+# flags are kept in sync with remote, other flags are only added
+SYNC_FLAGS = ('\\Answered', '\\Flagged', '\\Seen', '\\Draft')
+GM_FLAGS = {
+    '\\Answered': '\\Answered',
+    '\\Flagged': '\\Flagged',
+    '\\Deleted': '\\Deleted',
+    '\\Seen': '\\Seen',
+    '\\Draft': '\\Draft',
+}
+GM_LABELS = {
+    '\\Drafts': '\\Draft',
+    '\\Draft': '\\Draft',
+    '\\Starred': '\\Flagged',
+    '\\Inbox': '#inbox',
+    '\\Junk': '#spam',
+    '\\Trash': '#trash',
+    '\\Sent': '#sent',
+    '\\Chats': '#chats',
+    '\\Important': '',
+}
 
 
 @local.setting('remote/account')
@@ -38,6 +62,114 @@ def data_uidnext(key, value):
     return setting
 
 
+@local.metadata('remote/origins', lambda: {}, depth=3)
+def data_origins(update, uidvalidity=None, uidnext=None, rm=()):
+    """Imported messages in SRC: {header: {value: uid}}.
+
+    "uidnext" is the next uid which isn't indexed yet.
+    """
+    data = data_origins.get()
+    if uidvalidity and data.get('uidvalidity') != uidvalidity:
+        data = {'uidvalidity': uidvalidity, 'uidnext': 1}
+    ids = data.setdefault('ids', {})
+    for header in ORIGIN_HEADERS:
+        ids.setdefault(header, {})
+    if rm:
+        rm = set(rm)
+        for values in ids.values():
+            for value in [k for k, v in values.items() if v in rm]:
+                del values[value]
+
+    uids = set()
+    for header, values in update.items():
+        ids[header].update(values)
+        uids.update(int(i) for i in values.values())
+    uidnext = max(uidnext or 1, data.get('uidnext', 1))
+    for uid in sorted(uids):
+        # appended right after indexed ones, so no need to scan them again
+        if uid == uidnext:
+            uidnext += 1
+    data['uidnext'] = uidnext
+    return data
+
+
+@local.metadata('remote/flags', lambda: {}, depth=2)
+def data_remote_flags(update, uidvalidity=None, rm=()):
+    """Last known remote flags of imported messages in SRC: {uid: flags}.
+
+    Only remote changes of flags are applied to local messages,
+    so these are compared with new flags from remote.
+    """
+    data = data_remote_flags.get()
+    if uidvalidity and data.get('uidvalidity') != uidvalidity:
+        data = {'uidvalidity': uidvalidity}
+    flags = data.setdefault('flags', {})
+    for uid in rm:
+        flags.pop(uid, None)
+    flags.update(update)
+    return data
+
+
+@local.using(local.SRC, fresh=True)
+def origins(con=None):
+    """Index of imported messages, new messages are indexed first."""
+    data = data_origins.get()
+    uidnext = 1
+    if data.get('uidvalidity') == con.uidvalidity:
+        uidnext = data['uidnext']
+    if uidnext >= con.uidnext:
+        return dict({h: {} for h in ORIGIN_HEADERS}, **data.get('ids', {}))
+
+    fields = 'HEADER.FIELDS (%s)' % ' '.join(ORIGIN_HEADERS)
+    found = {h: {} for h in ORIGIN_HEADERS}
+    res = con.fetch_iter('%s:*' % uidnext, 'BODY.PEEK[%s]' % fields)
+    for uid, rec in res:
+        headers = email.message_from_bytes(rec['BODY[%s]' % fields])
+        for header in ORIGIN_HEADERS:
+            value = headers[header]
+            if value:
+                found[header][value.strip().strip('<>')] = uid
+    return data_origins(found, con.uidvalidity, con.uidnext)['ids']
+
+
+def origins_append(imported):
+    """Index appended messages by one write.
+
+    "imported" are (uidvalidity, uids, items) of batches, "items" are
+    ({header: value}, remote flags) in order of "uids".
+    """
+    update = {h: {} for h in ORIGIN_HEADERS}
+    flags = {}
+    uidvalidity = None
+    for uidvalidity, uids, items in imported:
+        for uid, (ids, remote) in zip(imap.UidSet(uids), items):
+            for header, value in ids.items():
+                update[header][value] = uid
+            flags[uid] = ' '.join(sorted(remote))
+    if uidvalidity:
+        data_origins(update, uidvalidity)
+        data_remote_flags(flags, uidvalidity)
+
+
+def forget_origins(uids):
+    """Drop expunged messages of SRC from the index of imported ones."""
+    data_origins({}, rm=uids)
+    data_remote_flags({}, rm=uids)
+
+
+local.expunge_hooks.append(forget_origins)
+
+
+def remote_flags(rec, gmail=False):
+    """Flags of a remote message in the form they are imported."""
+    if gmail:
+        flags = [GM_FLAGS.get(f, '') for f in rec.flags]
+        flags += [gm_label(i) for i in rec.gm.get('X-GM-LABELS') or []]
+    else:
+        flags = list(rec.flags)
+    return {f for f in flags if f and f != '\\Recent'}
+
+
 class Remote(imaplib.IMAP4, imap.Conn):
     def __init__(self):
         account = data_account.get()
@@ -64,8 +196,11 @@ def connect():
     return con
 
 
-def client(tag=None, box=None):
-    ctx = imap.client(connect)
+def client(tag=None, box=None, qresync=False):
+    ctx = imap.client(connect, compress='remote' in conf['IMAP_COMPRESS'])
+    if qresync:
+        # should be enabled before SELECT to get VANISHED responses
+        ctx.enable('QRESYNC')
     if box:
         ctx.select(box)
     elif tag:
@@ -73,44 +208,49 @@ def client(tag=None, box=None):
     return ctx
 
 
-@local.using(local.SRC)
-def fetch_imap(uids, box, tag=None, con=None):
+def folder_key(box=None, tag=None):
+    account = data_account.get()
+    return ':'.join((account['imap_host'], account['username'], tag or box))
+
+
+def gm_label(label):
+    if isinstance(label, list):
+        # unquoted label with parentheses
+        label = '(%s)' % ' '.join(label)
+    label = imap_utf7.decode(label)
+    flag = GM_LABELS.get(label, None)
+    if flag is None:
+        flag = local.get_tag(label)['id']
+    return flag
+
+
+@local.using(local.SRC, reuse=False)
+def fetch_imap(uids, box, tag, found, con=None):
     map_tags = {
         '\\Inbox': '#inbox',
         '\\Junk': '#spam',
         '\\Trash': '#trash',
         '\\Sent': '#sent',
     }
-    exists = {}
-    res = con.fetch('1:*', 'BODY.PEEK[HEADER.FIELDS (X-SHA256)]')
-    for i in range(0, len(res), 2):
-        uid = res[i][0].decode().split()[2]
-        line = res[i][1].strip()
-        if not line:
-            continue
-        hash = email.message_from_bytes(line)['X-SHA256'].strip()
-        exists[hash.strip('<>')] = uid
+    exists = found['X-SHA256']
+    appended = []
 
     def msgs(con):
         account = data_account.get()
-        res = con.fetch(uids, '(UID INTERNALDATE FLAGS BODY.PEEK[])')
-        for i in range(0, len(res), 2):
-            line, raw = res[i]
+        key = folder_key(box, tag)
+        res = con.fetch_iter(uids, '(UID INTERNALDATE FLAGS BODY.PEEK[])')
+        for uid, rec in res:
+            raw = rec['BODY[]']
             hash = hashlib.sha256(raw).hexdigest()
             if hash in exists:
                 continue
-            parts = re.search(
-                r'('
-                r'UID (?P<uid>\d+)'
-                r' ?|'
-                r'INTERNALDATE (?P<time>"[^"]+")'
-                r' ?|'
-                r'FLAGS \((?P<flags>[^)]*)\)'
-                r' ?){3}',
-                line.decode()
-            ).groupdict()
-
-            flags = parts['flags']
+
+            remote_uid = '%s/%s/%s' % (key, con.uidvalidity, uid)
+            appended.append((
+                {'X-SHA256': hash, 'X-Remote-UID': remote_uid},
+                remote_flags(rec)
+            ))
+            flags = str(rec.flags)
             if tag and tag in map_tags:
                 flags = ' '.join([flags, map_tags[tag]])
 
@@ -118,6 +258,7 @@ def fetch_imap(uids, box, tag=None, con=None):
                 'X-SHA256: <%s>' % hash,
                 'X-Remote-Host: <%s>' % account['imap_host'],
                 'X-Remote-Login: <%s>' % account['username'],
+                'X-Remote-UID: <%s>' % remote_uid,
             ]
 
             # line break should be in the end, so an empty string here
@@ -125,129 +266,57 @@ def fetch_imap(uids, box, tag=None, con=None):
             headers = '\r\n'.join(headers)
 
             raw = headers.encode() + raw
-            yield parts['time'], flags, raw
+            yield '"%s"' % rec.internaldate, flags, raw
 
     with client(box=box, tag=tag) as c:
-        msgs = list(msgs(c))
-    if not msgs:
+        # messages are appended while they are still being fetched
+        uids = con.multiappend(local.SRC, msgs(c))
+    if not uids:
         return None
+    return con.uidvalidity, uids, appended
 
-    return con.multiappend(local.SRC, msgs)
 
+@local.using(local.SRC, reuse=False)
+def fetch_gmail(uids, box, tag, found, con=None):
+    exists = found['X-GM-MSGID']
+    appended = []
 
-@local.using(local.SRC)
-def fetch_gmail(uids, box, tag, con=None):
-    map_flags = {
-        '\\Answered': '\\Answered',
-        '\\Flagged': '\\Flagged',
-        '\\Deleted': '\\Deleted',
-        '\\Seen': '\\Seen',
-        '\\Draft': '\\Draft',
-    }
-    map_labels = {
-        '\\Drafts': '\\Draft',
-        '\\Draft': '\\Draft',
-        '\\Starred': '\\Flagged',
-        '\\Inbox': '#inbox',
-        '\\Junk': '#spam',
-        '\\Trash': '#trash',
-        '\\Sent': '#sent',
-        '\\Chats': '#chats',
-        '\\Important': '',
-    }
-
-    exists = {}
-    res = con.fetch('1:*', 'BODY.PEEK[HEADER.FIELDS (X-GM-MSGID)]')
-    for i in range(0, len(res), 2):
-        uid = res[i][0].decode().split()[2]
-        line = res[i][1].strip()
-        if not line:
-            continue
-        gid = email.message_from_bytes(line)['X-GM-MSGID'].strip()
-        exists[gid.strip('<>')] = uid
-
-    new_uids = []
-    with client(tag, box=box) as gm:
-        res = gm.fetch(uids.str, 'X-GM-MSGID')
-        for line in res:
-            parts = re.search(
-                r'('
-                r'UID (?P<uid>\d+)'
-                r' ?|'
-                r'X-GM-MSGID (?P<msgid>\d+)'
-                r' ?){2}',
-                line.decode()
-            ).groupdict()
-            if parts['msgid'] in exists:
-                continue
-            new_uids.append(parts['uid'])
-        if not new_uids:
-            log.debug('%s are alredy imported' % uids)
-            return
+    def msgs(gm, uids):
         fields = (
             '('
-            'INTERNALDATE FLAGS BODY.PEEK[] '
+            'UID INTERNALDATE FLAGS BODY.PEEK[] '
             'X-GM-LABELS X-GM-MSGID X-GM-THRID'
             ')'
         )
-        res = gm.fetch(new_uids, fields)
         login = gm.username
-
-    def flag(m):
-        flag = m.group()
-        if flag:
-            return map_flags.get(flag, '')
-        return ''
-
-    def label(m):
-        label = m.group()
-        if label:
-            label = label.strip('"').replace('\\\\', '\\')
-            label = imap_utf7.decode(label)
-            flag = map_labels.get(label, None)
-            if flag is None:
-                flag = local.get_tag(label)['id']
-            return flag
-        return ''
-
-    def msgs():
-        for i in range(0, len(res), 2):
-            line, raw = res[i]
-            parts = re.search(
-                r'('
-                r'UID (?P<uid>\d+)'
-                r' ?|'
-                r'INTERNALDATE (?P<time>"[^"]+")'
-                r' ?|'
-                r'FLAGS \((?P<flags>[^)]*)\)'
-                r' ?|'
-                r'X-GM-LABELS \((?P<labels>.*)\)'
-                r' ?|'
-                r'X-GM-MSGID (?P<msgid>\d+)'
-                r' ?|'
-                r'X-GM-THRID (?P<thrid>\d+)'
-                r' ?){6}',
-                line.decode()
-            ).groupdict()
-            if not raw or parts['msgid'] in exists:
+        remote_uid = '%s/%s/%%s' % (folder_key(box, tag), gm.uidvalidity)
+        for _, rec in gm.fetch_iter(uids, fields):
+            raw = rec.get('BODY[]')
+            msgid = rec.gm['X-GM-MSGID']
+            if not raw or msgid in exists:
                 # this happens in "[Gmail]/Chats" folder
                 continue
-            flags = re.sub(r'([^ ])*', flag, parts['flags'])
-            flags = ' '.join([
-                flags,
-                re.sub(r'("[^"]*"|[^" ]*)', label, parts['labels']),
-                map_labels.get(tag, ''),
-            ]).strip()
+            flags = [GM_FLAGS.get(f, '') for f in rec.flags]
+            flags += [gm_label(i) for i in rec.gm.get('X-GM-LABELS') or []]
+            flags.append(GM_LABELS.get(tag, ''))
+            flags = ' '.join(f for f in flags if f)
             if SKIP_DRAFTS and '\\Draft' in flags:
                 # TODO: skip drafts for now
                 continue
 
+            ids = {
+                'X-SHA256': hashlib.sha256(raw).hexdigest(),
+                'X-GM-MSGID': msgid,
+                'X-Remote-UID': remote_uid % rec.uid,
+            }
+            appended.append((ids, remote_flags(rec, gmail=True)))
             headers = [
-                'X-SHA256: <%s>' % hashlib.sha256(raw).hexdigest(),
-                'X-GM-UID: <%s>' % parts['uid'],
-                'X-GM-MSGID: <%s>' % parts['msgid'],
-                'X-GM-THRID: <%s>' % parts['thrid'],
+                'X-SHA256: <%s>' % ids['X-SHA256'],
+                'X-GM-UID: <%s>' % rec.uid,
+                'X-GM-MSGID: <%s>' % msgid,
+                'X-GM-THRID: <%s>' % rec.gm['X-GM-THRID'],
                 'X-GM-Login: <%s>' % login,
+                'X-Remote-UID: <%s>' % ids['X-Remote-UID'],
             ]
             thrid_re = r'(^| )mlr/thrid/\d+'
             thrid = re.search(thrid_re, flags)
@@ -261,13 +330,78 @@ def fetch_gmail(uids, box, tag, con=None):
             headers = '\r\n'.join(headers)
 
             raw = headers.encode() + raw
-            yield parts['time'], flags, raw
+            yield '"%s"' % rec.internaldate, flags, raw
 
-    msgs = list(msgs())
-    if not msgs:
+    with client(tag, box=box) as gm:
+        res = gm.fetch_iter(uids, '(UID X-GM-MSGID)')
+        new_uids = [
+            uid for uid, rec in res if rec.gm['X-GM-MSGID'] not in exists
+        ]
+        if not new_uids:
+            log.debug('%s are alredy imported' % uids)
+            return None
+        # messages are appended while they are still being fetched
+        uids = con.multiappend(local.SRC, msgs(gm, new_uids))
+    if not uids:
         return None
+    return con.uidvalidity, uids, appended
+
+
+def fetch_changes(con, key, uidnext, modseq, gmail=False):
+    """Apply remote changes of flags and expunges since "modseq"."""
+    fields = '(UID FLAGS)'
+    sync_flags = set(SYNC_FLAGS)
+    if gmail and 'X-GM-EXT-1' in con.capabilities():
+        fields = '(UID FLAGS X-GM-LABELS)'
+        sync_flags.add('#inbox')
+    res, vanished = con.fetch_changes('1:%s' % (uidnext - 1), modseq, fields)
+    log.info(
+        'box(%s): %s changed, %s vanished', con.box, len(res), len(vanished)
+    )
+    if not res and not vanished:
+        return
 
-    return con.multiappend(local.SRC, msgs)
+    remote_uid = '%s/%s/%%s' % (key, con.uidvalidity)
+    changes = {remote_uid % rec.uid: rec for rec in res}
+    changes.update((remote_uid % uid, None) for uid in vanished)
+    found = origins()['X-Remote-UID']
+    # both are indexed by uids of SRC
+    uidvalidity = data_origins.get().get('uidvalidity')
+    known = data_remote_flags.get()
+    if known.get('uidvalidity') != uidvalidity:
+        known = {}
+    known = known.get('flags', {})
+    # without labels only flags can be compared
+    labels = not gmail or 'X-GM-LABELS' in fields
+    flags, deleted, state = {}, [], {}
+    for rid, rec in changes.items():
+        uid = found.get(rid)
+        if uid is None:
+            continue
+        elif rec is None:
+            deleted.append(uid)
+            continue
+        new = remote_flags(rec, gmail)
+        old = known.get(uid)
+        if old is None:
+            # remote flags are unknown, so remote state wins
+            add, rm = new, sync_flags - new
+        else:
+            old = set(old.split())
+            if not labels:
+                new |= old - sync_flags
+            # local changes are kept, if the flag isn't changed on remote
+            add, rm = new - old, old - new
+        state[uid] = ' '.join(sorted(new))
+        for cmd, changed in (('+FLAGS.SILENT', add), ('-FLAGS.SILENT', rm)):
+            for flag in changed:
+                flags.setdefault((cmd, flag), []).append(uid)
+    if flags or deleted:
+        local.origin_changes(flags, deleted)
+    if deleted:
+        data_origins({}, rm=deleted)
+    if state or deleted:
+        data_remote_flags(state, uidvalidity, rm=deleted)
 
 
 @fn_time
@@ -277,16 +411,32 @@ def fetch_folder(box=None, tag=None, **opts):
         raise ValueError('"box" or "tag" should be specified')
 
     account = data_account.get()
-    uidnext_key = account['imap_host'], account['username'], tag or box
-    uidnext_key = ':'.join(uidnext_key)
-    uidvalidity, uidnext = data_uidnext.key(uidnext_key, (None, None))
-    log.info('saved: uidvalidity=%s uidnext=%s', uidvalidity, uidnext)
-    con = client(tag=tag, box=box)
-    folder = {'uidnext': con.uidnext, 'uidval': con.uidvalidity}
-    log.info('remote: uidvalidity=%(uidval)s uidnext=%(uidnext)s', folder)
+    uidnext_key = folder_key(box, tag)
+    saved = data_uidnext.key(uidnext_key, (None, None))
+    # HIGHESTMODSEQ is saved only since CONDSTORE support
+    uidvalidity, uidnext, modseq = (list(saved) + [None])[:3]
+    log.info(
+        'saved: uidvalidity=%s uidnext=%s modseq=%s',
+        uidvalidity, uidnext, modseq
+    )
+    con = client(tag=tag, box=box, qresync=True)
+    folder = {
+        'uidnext': con.uidnext,
+        'uidval': con.uidvalidity,
+        'modseq': con.highestmodseq
+    }
+    log.info(
+        'remote: uidvalidity=%(uidval)s uidnext=%(uidnext)s '
+        'modseq=%(modseq)s', folder
+    )
     if folder['uidval'] != uidvalidity:
         uidvalidity = folder['uidval']
         uidnext = 1
+    elif modseq and folder['modseq'] and modseq < folder['modseq']:
+        if uidnext > 1:
+            fetch_changes(
+                con, uidnext_key, uidnext, modseq, account.get('gmail')
+            )
     uids = con.search('UID %s:*' % uidnext)
     uids = [i for i in uids if int(i) >= uidnext]
     uidnext = folder['uidnext']
@@ -295,9 +445,12 @@ def fetch_folder(box=None, tag=None, **opts):
     if len(uids):
         uids = imap.Uids(uids, **opts)
         fetch_uids = fetch_gmail if account.get('gmail') else fetch_imap
-        uids.call_async(fetch_uids, uids, box, tag)
+        # batches share the index of imported messages and it's updated
+        # once, instead of concurrent writes of each batch
+        res = uids.call_async(fetch_uids, uids, box, tag, origins())
+        origins_append(i for i in res if i)
 
-    data_uidnext(uidnext_key, (uidvalidity, uidnext))
+    data_uidnext(uidnext_key, (uidvalidity, uidnext, folder['modseq']))
 
 
 def fetch(**kw):
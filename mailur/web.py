@@ -100,8 +100,13 @@ def endpoint(callback):
     def inner(*args, **kwargs):
         try:
             return callback(*args, **kwargs)
-        finally:
+        except imap.errors:
+            # connections could be in inconsistent state after failure,
+            # otherwise they stay in the pool for next requests
             imap.clean_pool()
+            raise
+        finally:
+            imap.pool.release(conf['USER'])
     return inner
 
 
@@ -910,7 +915,9 @@ def thread(q, opts, preload=None):
 
     has_link = False
     parents = []
-    mids = local.data_msgids.get()
+    mids = local.data_msgids.lookup(*(
+        m['parent'] for m in msgs.values() if m['is_draft'] and m['parent']
+    ))
     for i, m in msgs.items():
         if m['is_link']:
             has_link = True
@@ -997,10 +1004,11 @@ def wrap_msgs(items, hide_tags=None):
     elif '#spam' in hide_tags:
         base_q = 'tag:#spam '
 
-    mids = local.data_msgids.get()
+    links = local.data_links.get()
+    mids = local.data_msgids.lookup(*sum(links, []))
     linked_uids = (
         sum((mids.get(mid, []) for mid in link), [])
-        for link in local.data_links.get()
+        for link in links
     )
     linked_uids = sum(linked_uids, [])
 
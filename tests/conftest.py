@@ -186,7 +186,20 @@ def gm_fake():
 
 @pytest.fixture
 def gm_client():
-    from mailur import local, remote, message
+    from mailur import imap, local, remote, message
+
+    orig_client = remote.client
+
+    def client(*a, **kw):
+        ctx = orig_client(*a, **kw)
+
+        def fetch_iter(uids, fields):
+            # responses come from "gm_client.fetch" through "uid" of "gm_fake"
+            for rec in imap.fetched(ctx.fetch(uids, fields)):
+                yield rec.uid, rec
+
+        ctx.fetch_iter = fetch_iter
+        return ctx
 
     remote.SKIP_DRAFTS = False
 
@@ -276,7 +289,8 @@ def gm_client():
     gm_client.time = time.time() - 36000
 
     with mock.patch('mailur.remote.connect', gm_fake):
-        yield gm_client
+        with mock.patch('mailur.remote.client', client):
+            yield gm_client
 
 
 def _msgs(box=None, uids='1:*', *, parsed=False, raw=False, policy=None):
@@ -0,0 +1,58 @@
+import sys
+
+from mailur import cache, conf, local
+
+
+def test_lru(patch):
+    cache.store.clear()
+    cache.stats.update(hits=0, misses=0, evictions=0, size=0)
+    with patch.dict('mailur.conf', {'CACHE_SIZE': 1000}):
+        cache.set('a', 'a' * 300)
+        cache.set('b', 'b' * 300)
+        assert cache.get('a') == 'a' * 300
+        cache.set('c', 'c' * 300)
+        # "b" is the least recently used
+        assert cache.get('b') is None
+        assert cache.exists('a') and cache.exists('c')
+        assert cache.info() == {
+            'hits': 1, 'misses': 1, 'evictions': 1, 'entries': 2,
+            'size': cache.sizeof('a' * 300) + cache.sizeof('c' * 300)
+        }
+
+        # users share the budget
+        with patch.dict('mailur.conf', {'USER': 'another'}):
+            cache.set('a', 'a' * 300, size=900)
+            assert cache.get('a') == 'a' * 300
+        assert not cache.exists('a')
+        assert not cache.exists('c')
+
+        cache.clear()
+        assert list(cache.store) == [('another', 'a')]
+        assert cache.info()['size'] == 900
+
+
+def test_ttl(patch):
+    cache.set('a', 1, ttl=-1)
+    assert not cache.exists('a')
+    assert cache.get('a', 0) == 0
+
+    with patch.dict('mailur.conf', {'CACHE_TTL': 0}):
+        cache.set('a', 1)
+    assert cache.store[(conf['USER'], 'a')][2] == 0
+    assert cache.get('a') == 1
+
+
+def test_sizeof():
+    value = {str(i): [str(i)] for i in range(10, 100)}
+    item = 2 * sys.getsizeof('10') + sys.getsizeof(['10'])
+    size = 90 * item
+    assert cache.sizeof(value) == sys.getsizeof(value) + size
+    pair = (1, value)
+    assert cache.sizeof(pair) == (
+        sys.getsizeof(pair) + sys.getsizeof(1) + cache.sizeof(value)
+    )
+    assert cache.sizeof('a' * 300) == sys.getsizeof('a' * 300)
+
+    # metadata is kept in subclasses of dict
+    tracked = local.Tracked(value)
+    assert cache.sizeof(tracked) == sys.getsizeof(tracked) + size
@@ -22,6 +22,9 @@ def test_general(gm_client, login, msgs, patch, call):
         cli.main('metadata %s' % login.user1)
         assert m.update_metadata.called
 
+        cli.main('metadata %s --rebuild' % login.user1)
+        assert m.rebuild_metadata.called
+
     cli.main('metadata %s' % login.user1)
 
     with patch('mailur.cli.remote.fetch_folder') as m:
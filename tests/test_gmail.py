@@ -1,6 +1,6 @@
 import re
 
-from mailur import local, remote
+from mailur import local, message, remote
 
 
 def test_client(some, patch, call):
@@ -10,7 +10,7 @@ def test_client(some, patch, call):
 
         assert set(con.__dict__.keys()) == set(
             '_con parent logout list select select_tag status search '
-            'fetch idle copy'
+            'fetch fetch_iter fetch_changes idle copy noop capabilities enable'
             .split()
         )
 
@@ -101,6 +101,41 @@ def test_fetch_and_parse(gm_client, some, raises):
     assert lm.status(local.ALL, '(UIDNEXT)') == [b'mlr/All (UIDNEXT 7)']
 
 
+def test_fetch_changes(gm_client, msgs):
+    remote.data_account({
+        'username': 'test@test.com',
+        'password': 'test',
+        'imap_host': 'imap.test.com',
+        'smtp_host': 'smtp.test.com'
+    })
+    gm_client.add_emails([{}, {'flags': '\\Seen'}])
+    assert [i['flags'] for i in msgs(local.SRC)] == ['', '\\Seen']
+    assert [i['flags'] for i in msgs()] == ['', '\\Seen']
+
+    gm = remote.connect()
+    gm.select('mlr')
+    gm._uid('STORE', '1', '+FLAGS', '\\Flagged #1')
+    gm._uid('STORE', '2', '-FLAGS', '\\Seen')
+    remote.fetch_folder(tag='\\All')
+    assert [i['flags'] for i in msgs(local.SRC)] == ['\\Flagged #1', '']
+    assert [i['flags'] for i in msgs()] == ['\\Flagged #1', '']
+
+    # local changes are kept if the flag isn't changed on remote
+    local.msgs_flag(['1'], [], ['\\Seen'])
+    gm._uid('STORE', '1', '+FLAGS', '\\Answered')
+    remote.fetch_folder(tag='\\All')
+    flags = {'\\Answered', '\\Flagged', '\\Seen', '#1'}
+    assert set(msgs(local.SRC)[0]['flags'].split()) == flags
+    assert set(msgs()[0]['flags'].split()) == flags
+
+    gm._uid('STORE', '1', '+FLAGS.SILENT', '\\Deleted')
+    gm.expunge()
+    remote.fetch_folder(tag='\\All')
+    assert [i['uid'] for i in msgs(local.SRC)] == ['2']
+    assert [i['uid'] for i in msgs()] == ['2']
+    assert len(msgs(local.DEL)) == 1
+
+
 def test_origin_msg(gm_client, latest, login):
     gm_client.add_emails(parse=False)
     msg = latest(local.SRC)['body']
@@ -185,3 +220,24 @@ def test_unique(gm_client, msgs):
     gid = m['body']['X-GM-MSGID']
     gm_client.add_emails([{'gid': int(gid.strip('<>'))}], parse=False)
     assert [i['body']['X-GM-THRID'] for i in msgs(local.SRC)] == [gid]
+
+    origins = remote.data_origins.get()
+    assert origins['uidnext'] == 2
+    assert origins['ids']['X-GM-MSGID'] == {gid.strip('<>'): '1'}
+
+    # messages appended not by import are indexed on the way
+    local.new_msg(message.binary('42'), '', no_parse=True)
+    assert remote.origins()['X-GM-MSGID'] == {gid.strip('<>'): '1'}
+    assert remote.data_origins.get()['uidnext'] == 3
+
+    gm_client.add_emails([{}], parse=False)
+    origins = remote.data_origins.get()
+    assert origins['uidnext'] == 4
+    assert len(origins['ids']['X-SHA256']) == 2
+
+    # expunged messages are dropped from the index
+    local.parse()
+    local.del_msg(local.pair_origin_uids(['3'])[0])
+    origins = remote.data_origins.get()
+    assert '3' not in origins['ids']['X-SHA256'].values()
+    assert len(origins['ids']['X-SHA256']) == 1
@@ -1,3 +1,9 @@
+import socket
+import time
+from unittest import mock
+
+import gevent
+
 from mailur import imap, local, message
 
 
@@ -35,6 +41,141 @@ def test_batched_uids(gm_client):
     assert local.parse(batch=10) is None
 
 
+def test_conn_pool(patch):
+    def create():
+        con = mock.Mock()
+        con.noop.return_value = ['']
+        return con
+
+    pool = imap.ConnPool(size=2, users=2, timeout=60, check=10)
+    c1 = pool.get(('u1', 'c', 'a'), create)
+    assert pool.get(('u1', 'c', 'a'), create) is c1
+    assert not c1.noop.called
+
+    c2 = pool.get(('u1', 'c', 'b'), create)
+    pool.get(('u1', 'c', 'c'), create)
+    assert ('u1', 'c', 'a') not in pool
+    assert c1.logout.called
+    assert not c2.logout.called
+
+    pool.get(('u2', 'c', 'a'), create)
+    pool.get(('u3', 'c', 'a'), create)
+    assert [k[0] for k in pool.keys()] == ['u2', 'u3']
+    assert c2.logout.called
+
+    now = time.time()
+    with patch('mailur.imap.time.time') as m:
+        m.return_value = now + 20
+        c3 = pool.get(('u3', 'c', 'a'), create)
+        assert c3.noop.called
+
+        c3.noop.side_effect = imap.Error('expired')
+        m.return_value += 20
+        assert pool.get(('u3', 'c', 'a'), create) is not c3
+        assert c3.logout.called
+
+        m.return_value += 120
+        u3 = pool.get(('u3', 'c', 'a'), create)
+        assert pool.keys() == [('u3', 'c', 'a')]
+
+    pool.clean('u3')
+    assert u3.logout.called
+    assert pool.keys() == []
+
+    # connections in use aren't closed
+    with pool.use(('u1', 'c', 'a'), create) as c1:
+        pool.get(('u1', 'c', 'b'), create)
+        pool.get(('u1', 'c', 'c'), create)
+        pool.get(('u2', 'c', 'a'), create)
+        pool.get(('u3', 'c', 'a'), create)
+        assert ('u1', 'c', 'a') in pool
+        assert not c1.logout.called
+    pool.get(('u3', 'c', 'b'), create)
+    assert c1.logout.called
+    assert [k[0] for k in pool.keys()] == ['u2', 'u3', 'u3']
+
+    # replaced connection is closed when nobody uses it
+    key = ('u3', 'c', 'a')
+    with pool.use(key, create) as old:
+        with pool.use(key, create):
+            new = create()
+            pool.set(key, new)
+            assert pool.get(key, create) is new
+        assert not old.logout.called
+    assert old.logout.called
+    assert not new.logout.called
+
+
+def test_conn_pool_concurrent():
+    def create():
+        gevent.sleep(0.01)
+        return mock.Mock()
+
+    pool = imap.ConnPool()
+    jobs = [gevent.spawn(pool.get, ('u1', 'c', 'a'), create) for i in '12']
+    gevent.joinall(jobs, raise_error=True)
+    assert jobs[0].value is jobs[1].value
+    assert pool.keys() == [('u1', 'c', 'a')]
+
+
+def test_select(gm_client, patch):
+    con = local.client(local.SRC)
+    assert con.uidnext == 1
+    with patch('imaplib.IMAP4.select', wraps=con._con.select) as m:
+        assert con.select(local.SRC) == [b'0']
+        assert not m.called
+
+        con.select(local.SRC, readonly=False)
+        assert m.call_count == 1
+        con.select(local.SRC, readonly=False)
+        assert m.call_count == 1
+
+        gm_client.add_emails([{}, {}], parse=False)
+        assert con.select(local.SRC, readonly=False) == [b'0']
+        assert con.uidnext == 1
+        assert con.select(local.SRC, readonly=False, fresh=True) == [b'2']
+        assert con.uidnext == 3
+        assert m.call_count == 1
+
+        con.synced = False
+        con.select(local.SRC, readonly=False)
+        assert m.call_count == 1
+
+        con.select(local.ALL, readonly=False)
+        assert m.call_count == 2
+        assert con.box == local.ALL
+
+
+def test_pipeline(gm_client, raises):
+    gm_client.add_emails([{'flags': '#1'}, {'flags': '#2'}, {}])
+    con = local.client(readonly=False)
+    assert con.pipeline([]) == []
+    assert con.pipeline([
+        ('SEARCH', 'keyword #1'),
+        ('SEARCH', 'keyword #2'),
+        ('SEARCH', 'keyword #3'),
+        ('SEARCH', 'ALL'),
+    ]) == [['1'], ['2'], [], ['1', '2', '3']]
+
+    res = con.pipeline([
+        ('STORE', '1:2', '+FLAGS.SILENT', '#3'),
+        ('STORE', '3', '+FLAGS.SILENT', '#4'),
+        ('SEARCH', 'keyword #3'),
+    ])
+    assert res[-1] == ['1', '2']
+    assert con.search('keyword #4') == ['3']
+
+    with raises(imap.Error):
+        con.pipeline([('SEARCH', 'ALL'), ('SEARCH', 'unknown')])
+
+    # untagged FETCH would stay in responses, so STORE must be silent
+    with raises(ValueError):
+        con.pipeline([('STORE', '1', '+FLAGS', '#5')])
+    assert con.search('keyword #5') == []
+    assert 'FETCH' not in con._con.untagged_responses
+    assert con.search('ALL') == ['1', '2', '3']
+
+
 def test_fn_parse_thread():
     fn = imap.parse_thread
     assert fn('(1)(2 3)') == (['1'], ['2', '3'])
@@ -46,6 +187,90 @@ def test_fn_parse_thread():
     assert fn(b'(1)(2)(3)') == (['1'], ['2'], ['3'])
 
 
+def test_fetch_iter(gm_client, raises):
+    gm_client.add_emails([{'txt': '1'}, {'txt': '2'}, {'txt': '3'}])
+    con = local.client()
+    res = list(con.fetch_iter('1:*', '(UID FLAGS BINARY.PEEK[1])'))
+    assert [uid for uid, rec in res] == ['1', '2', '3']
+    assert res[0][1].flags == set()
+    assert res[0][1]['BINARY[1]'].startswith(b'{')
+
+    res = con.fetch_iter(['1', '3'], '(FLAGS)')
+    assert next(res)[0] == '1'
+    # other commands would read responses of the iterator
+    with raises(imap.Error) as e:
+        con.search('ALL')
+    assert 'is not drained' in str(e.value)
+    res.close()
+    # connection is still usable after iteration is stopped
+    assert [i[0] for i in con.fetch_iter('2:3', '(FLAGS)')] == ['2', '3']
+
+    res = con.fetch_iter([str(i) for i in range(1, 30)], 'FLAGS')
+    assert [i[0] for i in res] == ['1', '2', '3']
+    assert list(con.fetch_iter([], 'FLAGS')) == []
+
+
+def test_fn_parse_fetch(raises):
+    fn = imap.parse_fetch
+    assert fn(b'2 (UID 7 FLAGS ())') == ('2', {'UID': '7', 'FLAGS': []})
+    assert fn(b'3 (FLAGS (\\Seen #1) UID 3)') == (
+        '3', {'UID': '3', 'FLAGS': ['\\Seen', '#1']}
+    )
+
+    res = [
+        (
+            b'1 (UID 1 INTERNALDATE "01-Jan-2018 10:00:00 +0000" '
+            b'BODY[] {5}', b'hello'
+        ),
+        (b' BINARY[1] ~{3}', b'abc'),
+        b' X-GM-LABELS ("\\\\Inbox" "a b" c)'
+        b' BODY[HEADER.FIELDS (Subject)] NIL)',
+        b'2 (UID 2 FLAGS (\\Seen))',
+    ]
+    items = list(imap.fetch_items(res))
+    assert len(items) == 2
+    assert fn(items[0]) == ('1', {
+        'UID': '1',
+        'INTERNALDATE': '01-Jan-2018 10:00:00 +0000',
+        'BODY[]': b'hello',
+        'BINARY[1]': b'abc',
+        'X-GM-LABELS': ['\\Inbox', 'a b', 'c'],
+        'BODY[HEADER.FIELDS (SUBJECT)]': None,
+    })
+    assert fn(items[1]) == ('2', {'UID': '2', 'FLAGS': ['\\Seen']})
+
+    rec = imap.fetched(res)[0]
+    assert rec.uid == '1'
+    assert rec.flags is None
+    assert rec.internaldate == '01-Jan-2018 10:00:00 +0000'
+    assert rec['BODY[]'] == b'hello'
+    assert rec['BINARY[1]'] == b'abc'
+    assert rec.get('BODY[HEADER.FIELDS (SUBJECT)]') is None
+    assert rec.gm == {'X-GM-LABELS': ['\\Inbox', 'a b', 'c']}
+
+    rec = imap.fetched([
+        b'3 (MODSEQ (12) FLAGS (\\Seen #1 #2) UID 3)',
+        b'4 (X-GM-MSGID 10 UID 4 X-GM-THRID 11 FLAGS ())'
+    ])
+    assert [i.uid for i in rec] == ['3', '4']
+    assert rec[0].modseq == 12
+    assert rec[0].flags == {'#1', '#2', '\\Seen'}
+    assert list(rec[0].flags) == ['\\Seen', '#1', '#2']
+    assert str(rec[0].flags) == '\\Seen #1 #2'
+    assert rec[1].gm == {'X-GM-MSGID': '10', 'X-GM-THRID': '11'}
+    assert rec[1].flags == set()
+
+    # unsolicited FETCH with flags of another message or without sections
+    fields = '(BODY.PEEK[] BINARY.PEEK[1] BODY.PEEK[HEADER.FIELDS (Subject)])'
+    assert [i.uid for i in imap.fetched(res, '1', fields)] == ['1']
+    assert imap.fetched(res, '2', fields) == []
+    assert [i.uid for i in imap.fetched(res, '1:*', '(FLAGS)')] == ['1', '2']
+    assert imap.fetched(res, '2', 'BINARY.PEEK[1]<0.3>') == []
+
+    with raises(imap.Error):
+        fn(b'1 (UID 1 FLAGS (\\Seen) "unclosed)')
+
+
 def test_fn_pack_uids():
     fn = imap.pack_uids
     assert fn(['1', '2', '3', '4']) == '1:4'
@@ -53,6 +278,32 @@ def test_fn_pack_uids():
     assert fn(['100', '1', '4', '3', '10', '9', '8', '7']) == '1,3:4,7:10,100'
 
 
+def test_uid_set():
+    uids = imap.UidSet(['10', '1', '2', '3', '7', '9', '2'])
+    assert str(uids) == '1:3,7,9:10'
+    assert list(uids) == ['1', '2', '3', '7', '9', '10']
+    assert len(uids) == 6
+    assert '2' in uids and 10 in uids and '8' not in uids
+    assert imap.UidSet('9:10,1:3,7') == uids
+    assert not imap.UidSet([])
+
+    other = imap.UidSet('2:8')
+    assert str(uids | other) == '1:10'
+    assert str(uids & other) == '2:3,7'
+    assert str(uids - other) == '1,9:10'
+    assert str(other - uids) == '4:6,8'
+    assert str(uids - ['1', '10']) == '2:3,7,9'
+    assert [str(i) for i in uids.split(2)] == ['1:3,7', '9:10']
+
+    uids = imap.Uids(imap.UidSet(range(1, 100, 2)), batch=10)
+    assert len(uids.batches) == 5
+    assert uids.batches[0].str == '1,3,5,7,9,11,13,15,17,19'
+    uids = imap.Uids([str(i) for i in range(1, 25001)])
+    assert [i.str for i in uids.batches] == [
+        '1:10000', '10001:20000', '20001:25000'
+    ]
+
+
 def test_literal_size_limit(gm_client, raises):
     # for query like "UID 1,2,...,150000" should be big enough
     gm_client.add_emails([{} for i in range(0, 20)], parse=False)
@@ -69,7 +320,7 @@ def test_literal_size_limit(gm_client, raises):
     assert 'Too long argument' in str(e.value)
 
 
-def test_multiappend(patch, msgs):
+def test_multiappend(patch, msgs, raises):
     new = [
         (None, None, message.binary(str(i)).as_bytes())
         for i in range(0, 10)
@@ -99,6 +350,59 @@ def test_multiappend(patch, msgs):
     con.multiappend(local.SRC, new, batch=3)
     assert len(msgs(local.SRC)) == 20
 
+    # LITERAL+ is used by default, check fallback without it
+    assert 'LITERAL+' in con._con.capabilities
+    with patch.object(con._con, 'capabilities', ()):
+        with patch.object(con._con, 'send', wraps=con._con.send) as m:
+            uids = con.multiappend(local.SRC, new[:2])
+            assert uids == '21:22'
+            assert b'{1}\r\n' in m.call_args_list[0][0][0]
+    with patch.object(con._con, 'send', wraps=con._con.send) as m:
+        uids = con.multiappend(local.SRC, iter(new[:2]))
+        assert uids == '23:24'
+        assert b'{1+}\r\n' in m.call_args_list[0][0][0]
+    assert con.multiappend(local.SRC, iter([])) is None
+    assert len(msgs(local.SRC)) == 24
+
+    # interrupted APPEND can't be finished, so the connection is dropped
+    def broken():
+        yield new[0]
+        raise ValueError('broken')
+
+    with raises(ValueError):
+        con.multiappend(local.SRC, broken())
+    with raises(imap.Error):
+        con.noop()
+    assert len(msgs(local.SRC)) == 24
+
+
+def test_deflate_socket():
+    one, two = socket.socketpair()
+    one, two = imap.DeflateSocket(one), imap.DeflateSocket(two)
+    one.sendall(b'* OK hello\r\n')
+    one.sendall(b'1 (BODY[] {100000}\r\n' + b'x' * 100000 + b')\r\n')
+    f = two.makefile('rb')
+    assert f.readline() == b'* OK hello\r\n'
+    assert f.readline() == b'1 (BODY[] {100000}\r\n'
+    assert f.read(100000) == b'x' * 100000
+    assert f.readline() == b')\r\n'
+
+    two.sendall(b'A1 OK done\r\n')
+    assert one.makefile('rb').readline() == b'A1 OK done\r\n'
+    one.close()
+    two.close()
+
+
+def test_compress(patch):
+    con = local.client(None)
+    with patch.object(con._con, 'capability') as m:
+        m.return_value = 'OK', [b'IMAP4rev1 IDLE']
+        assert not imap.enable_compress(con._con)
+
+    if imap.enable_compress(con._con):
+        assert isinstance(con._con.sock, imap.DeflateSocket)
+        assert con.select(local.SRC) == [b'0']
+
 
 def test_idle():
     def handler():
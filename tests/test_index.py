@@ -0,0 +1,67 @@
+from mailur import cache, index, local
+
+
+def test_storage(patch, tmpdir):
+    with patch.dict('mailur.conf', {'METADATA_DB': str(tmpdir)}):
+        index.connections.clear()
+        assert index.enabled()
+        assert index.version('msgs') is None
+        assert index.load('msgs') == (None, [])
+
+        delta = {'set': [[['1'], {'uid': '1'}], [['2'], {'uid': '2'}]]}
+        assert index.save('msgs', delta, {}) == 1
+        assert index.names() == ['msgs']
+        assert index.lookup('msgs', ['2']) == {'uid': '2'}
+
+        assert index.save('msgs', {'rm': [['1']]}) == 2
+        assert index.load('msgs') == ({}, [[['2'], {'uid': '2'}]])
+        assert index.lookup('msgs', ['1']) is None
+
+        # with "root" previous items are replaced
+        assert index.save('msgs', {'set': [[['3'], {}]]}, {}) == 3
+        assert index.load('msgs') == ({}, [[['3'], {}]])
+
+        value = {'1': {'uid': '1'}}
+        version = local.metadata_index_save('addresses', value, None, 1)
+        assert index.version('addresses') == version
+        assert local.metadata_index_load('addresses') == value
+        delta = {'rm': [['1']], 'set': [[['2'], {}]]}
+        local.metadata_index_save('addresses', value, delta, 1)
+        assert local.metadata_index_load('addresses') == {'2': {}}
+
+
+def test_metadata(gm_client, patch, tmpdir):
+    gm_client.add_emails([{}, {}])
+    msgs = {k: v.copy() for k, v in local.data_msgs.get().items()}
+    threads = local.data_threads.get()[1]
+    assert threads == {'1': ['1'], '2': ['2']}
+
+    with patch.dict('mailur.conf', {'METADATA_DB': str(tmpdir)}):
+        index.connections.clear()
+        cache.clear()
+        # records are copied from "mlr/Sys" on the first access
+        assert local.data_msgs.get() == msgs
+        assert 'msgs/0' in index.names()
+        # settings can't be built again, so they stay in "mlr/Sys"
+        local.data_links([])
+        assert local.data_links.get() == []
+        assert not [i for i in index.names() if i.startswith('settings/')]
+
+        gm_client.add_emails([{}])
+        assert sorted(local.data_msgs.get()) == ['1', '2', '3']
+        assert index.lookup('msgs/0', ['3'])['origin_uid'] == '3'
+
+        cache.clear()
+        assert sorted(local.data_msgs.get()) == ['1', '2', '3']
+        addrs_from, addrs_to = local.data_addresses.get()
+
+        index.save('msgs/0', {'set': [[['9'], {'uid': '9'}]]})
+        local.rebuild_metadata()
+        cache.clear()
+        # the rebuild replaces all rows, so none is stale
+        assert len(index.load('msgs/0')[1]) == 3
+        assert sorted(local.data_msgs.get()) == ['1', '2', '3']
+        assert local.data_threads.get()[1] == {
+            '1': ['1'], '2': ['2'], '3': ['3']
+        }
+        assert local.data_addresses.get() == [addrs_from, addrs_to]
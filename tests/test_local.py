@@ -1,4 +1,4 @@
-from mailur import local
+from mailur import cache, imap, local, lock
 
 
 def test_uidpairs(gm_client, msgs, patch, call):
@@ -32,14 +32,24 @@ def test_uidpairs(gm_client, msgs, patch, call):
     local.data_uidpairs.get()
     local.data_threads.get()
     local.data_msgids.get()
+    local.data_refs.get()
+    fetch_iter = {'wraps': imap._fetch_iter}
     with patch('imaplib.IMAP4.uid') as m:
         m.return_value = 'OK', []
-        local.update_metadata('4')
-        assert m.called
-        assert m.call_args_list == [
-            call('FETCH', '4', '(FLAGS BINARY.PEEK[1])'),
-            call('FETCH', '1:*', '(UID BODY[HEADER.FIELDS (Subject)])'),
-            call('THREAD', 'REFS UTF-8 INTHREAD REFS UID 4'),
+        with patch('mailur.imap._fetch_iter', **fetch_iter) as f:
+            local.update_metadata('4')
+        # messages are fetched by "fetch_iter" and threads are built
+        # from "data_refs" instead of THREAD, so there are no UID commands
+        assert not m.called
+        assert [
+            (c.args[0].current_box, c.args[1].str, c.args[2])
+            for c in f.call_args_list
+        ] == [
+            (local.ALL, '4', (
+                '(FLAGS BINARY.PEEK[1] '
+                'BODY.PEEK[HEADER.FIELDS (References)])'
+            )),
+            (local.ALL, '4', '(UID FLAGS)'),
         ]
 
     patched = {'wraps': local.update_metadata}
@@ -63,6 +73,328 @@ def test_uidpairs(gm_client, msgs, patch, call):
         assert m.call_args == call('9')
 
 
+def test_metadata_journal(gm_client, patch):
+    value = [{'1': ['1', '2'], '3': ['3']}, {}]
+    assert local.metadata_paths(value, 2) == [(0, '1'), (0, '3')]
+    delta = {'rm': [[0, '3']], 'set': [[[0, '1'], ['1']], [[1, 'a'], 1]]}
+    value = local.metadata_apply(value, delta)
+    assert value == [{'1': ['1']}, {'a': 1}]
+
+    value = local.metadata_track({'a': {'b': 1}, 'c': {}}, 3, clear=True)
+    assert local.metadata_changes(value, value, 3) == ([], [])
+    value['a']['d'] = 2
+    value['c'] = {'e': {'f': 3}}
+    value.pop('x', None)
+    assert local.metadata_changes(value, value, 3) == (
+        [('c', 'e', 'f'), ('a', 'd')], [('c',)]
+    )
+    assert local.metadata_changes(dict(value), value, 3) is None
+    assert local.metadata_delta(value, value, 3, full=True) == {
+        'rm': [['c']], 'set': [[['c', 'e', 'f'], 3], [['a', 'd'], 2]]
+    }
+    # most of items are changed, so the snapshot is saved
+    assert local.metadata_delta(value, value, 3) is None
+    assert local.metadata_delta(dict(value), value, 3, full=True) is None
+
+    value = local.metadata_track({'a': 1, 'b': 2}, 1, clear=True)
+    value['a'] = 3
+    value = local.metadata_replay(value, [{'set': [[['b'], 4]]}], 1)
+    assert value == {'a': 3, 'b': 4}
+    # items from deltas of other writers aren't saved again
+    assert local.metadata_delta(value, value, 1, full=True) == {
+        'rm': [], 'set': [[['a'], 3]]
+    }
+
+    gm_client.add_emails([{}, {}])
+    assert len(local.metadata_uids()['msgs/0']) == 1
+
+    gm_client.add_emails([{}])
+    assert len(local.metadata_uids()['msgs/0']) == 2
+    msgs = local.data_msgs.get()
+    assert sorted(msgs) == ['1', '2', '3']
+    msgs = {k: v.copy() for k, v in msgs.items()}
+
+    # like a new process
+    cache.clear()
+    assert local.data_msgs.get() == msgs
+
+    with patch.dict('mailur.conf', {'METADATA_JOURNAL': 1}):
+        gm_client.add_emails([{}])
+    assert len(local.metadata_uids()['msgs/0']) == 1
+    assert sorted(local.data_msgs.get()) == ['1', '2', '3', '4']
+
+    local.clean_msgs(['4'])
+    assert len(local.metadata_uids()['msgs/0']) == 2
+    cache.clear()
+    assert local.data_msgs.get() == msgs
+
+
+def test_metadata_format(gm_client):
+    value = [{'1': ['1', '2']}, {'a': {'b': None}}]
+    data = local.metadata_dumps(tuple(value))
+    assert data.startswith(local.METADATA_MAGIC)
+    assert local.metadata_loads(data) == value
+    assert local.metadata_loads(b'{"1":["1"]}') == {'1': ['1']}
+
+    gm_client.add_emails([{}])
+    msgs = dict(local.data_msgs.get())
+
+    # saved as JSON before binary records
+    msg = local.message.binary(local.json.dumps(msgs))
+    msg.add_header('Subject', 'msgs/0')
+    with local.client(local.SYS, readonly=False) as con:
+        con.append(local.SYS, None, None, msg.as_bytes())
+    cache.clear()
+    assert local.data_msgs.get() == msgs
+
+
+def test_metadata_lookup(gm_client, patch):
+    value = {str(i): [i] for i in range(5)}
+    with patch('mailur.local.METADATA_BUCKET_SIZE', 1):
+        data = local.metadata_dumps(value, buckets=True)
+        assert len(local.metadata_offsets(data)) == 6
+        assert local.metadata_loads(data) == value
+
+        gm_client.add_emails([{}, {}, {}, {}, {}])
+    gm_client.add_emails([{}])
+    assert len(local.metadata_uids()['msgids']) == 2
+    mids = dict(local.data_msgids.get())
+    first, last = sorted(mids, key=lambda i: mids[i])[::5]
+
+    # like a new process
+    cache.clear()
+    found = local.data_msgids.lookup(first, last, '<unknown>')
+    assert found == {first: mids[first], last: mids[last]}
+    assert cache.get('metadata:msgids') is None
+    assert len(cache.get('metadata:msgids:lazy')['buckets']) <= 3
+    uids = local.metadata_uids()['msgids']
+    found = local.metadata_buckets('msgids', uids, [first])
+    assert found == {first: mids[first]}
+    assert local.data_msgids.key(last) == mids[last]
+
+    assert local.pair_origin_uids(['1', '6']) == ('1', '6')
+    assert local.pair_parsed_uids(['1', '6']) == ('1', '6')
+    msgs = local.data_msgs.get()
+    assert local.data_msgs.lookup('6', 'x') == {'6': msgs['6']}
+
+
+def test_metadata_transaction(gm_client, raises):
+    gm_client.add_emails([{}])
+    uids = local.metadata_uids()
+    with local.metadata_transaction():
+        local.data_uidpairs({'1': '1', '2': '2'})
+        local.data_msgids({})
+        assert local.metadata_uids() == uids
+        assert local.data_uidpairs.get() == {'1': '1', '2': '2'}
+        assert local.data_uidpairs.lookup('2') == {'2': '2'}
+        # records are locked only while they are saved at the end
+        with lock.user_scope('uidpairs', wait=0):
+            pass
+
+    uids = local.metadata_uids()
+    assert int(uids['msgids'][-1]) == int(uids['uidpairs'][-1]) + 1
+    cache.clear()
+    assert local.data_uidpairs.get() == {'1': '1', '2': '2'}
+    assert local.data_msgids.get() == {}
+
+    with raises(ValueError):
+        with local.metadata_transaction():
+            local.data_msgids({'<1@mlr>': ['1']})
+            raise ValueError
+    assert local.metadata_uids() == uids
+    assert local.data_msgids.get() == {}
+
+
+def test_settings(gm_client):
+    def settings(value):
+        return value
+
+    # all settings were saved in one record before
+    local.metadata('settings', dict)(settings)({
+        'links': [['<1@mlr>', '<2@mlr>']],
+        'drafts': {'<3@mlr>': {'subject': 'old'}},
+    })
+    assert local.data_links.get() == [['<1@mlr>', '<2@mlr>']]
+    assert local.data_drafts.key('<3@mlr>') == {'subject': 'old'}
+    assert 'settings/links' not in local.metadata_uids()
+
+    local.data_drafts({'<4@mlr>': {'subject': 'new'}})
+    assert 'settings/drafts' in local.metadata_uids()
+    assert 'settings/links' not in local.metadata_uids()
+    assert sorted(local.data_drafts.get()) == ['<3@mlr>', '<4@mlr>']
+
+    local.data_links.unset()
+    assert local.data_links.get() == []
+    cache.clear()
+    assert local.data_links.get() == []
+    assert sorted(local.data_drafts.get()) == ['<3@mlr>', '<4@mlr>']
+
+
+def test_metadata_uids(gm_client):
+    gm_client.add_emails([{}])
+    local.metadata_uids()
+    gm_client.add_emails([{}, {}])
+    uids = local.metadata_uids()
+    state = cache.get('metadata:uids')
+    assert state['clean']
+
+    cache.clear()
+    assert local.metadata_uids() == uids
+    assert cache.get('metadata:uids')['clean'] == state['clean']
+
+    # obsolete records are expunged by somebody else
+    with local.client(local.SYS, readonly=False) as con:
+        con.store(state['clean'], '+FLAGS.SILENT', '\\Deleted')
+        con.expunge()
+        exists = len(con.search('ALL'))
+    assert local.metadata_uids() == uids
+    assert cache.get('metadata:uids')['exists'] == exists
+    assert cache.get('metadata:uids')['clean'] == []
+
+
+def test_shards(gm_client, patch):
+    def msgs(value):
+        return value
+
+    # saved before sharding
+    local.metadata('msgs', dict)(msgs)({'1': {'origin_uid': '1'}})
+    assert local.data_msgs.get() == {'1': {'origin_uid': '1'}}
+    assert 'msgs/0' in local.metadata_uids()
+
+    with patch('mailur.local.SHARD_SIZE', 2):
+        local.data_msgs({})
+        gm_client.add_emails([{}, {}, {}])
+        names = [i for i in local.metadata_uids() if i.startswith('msgs/')]
+        assert sorted(names) == ['msgs/0', 'msgs/1']
+
+        msgs = local.data_msgs.get()
+        assert msgs['3']['origin_uid'] == '3'
+        assert '4' not in msgs
+        assert list(msgs.loaded) == [1]
+        assert sorted(msgs) == ['1', '2', '3']
+
+        thrids, thrs = local.data_threads.get()
+        assert thrids == {'1': '1', '2': '2', '3': '3'}
+        assert thrs == {'1': ['1'], '2': ['2'], '3': ['3']}
+
+
+def test_msgs(gm_client):
+    msgs = local.Msgs({
+        '2': {'arrived': 2, 'msgid': '<2@mlr>', 'origin_uid': '5'},
+        '1': {
+            'arrived': 1, 'msgid': '<1@mlr>', 'origin_uid': '4',
+            'from': {'addr': 'a@t.com'}, 'parent': '<2@mlr>'
+        },
+        'x': {'origin_uid': 'x'}
+    })
+    assert list(msgs) == ['1', '2', 'x']
+    assert msgs['1'] == {
+        'arrived': 1, 'msgid': '<1@mlr>', 'origin_uid': '4',
+        'from': {'addr': 'a@t.com'}, 'parent': '<2@mlr>'
+    }
+    assert msgs.field('2', 'origin_uid') == '5'
+    assert msgs.field('x', 'origin_uid') == 'x'
+    msgs['1']['from']['addr'] = 'b@t.com'
+    assert msgs['1']['from'] == {'addr': 'a@t.com'}
+    del msgs['1']
+    assert list(msgs) == ['2', 'x']
+
+    gm_client.add_emails([{}, {'from': 'a@t.com'}])
+    msgs = local.data_msgs.get()
+    assert isinstance(msgs.loaded[0], local.Msgs)
+    assert msgs['2']['from']['addr'] == 'a@t.com'
+    assert msgs.field('2', 'origin_uid') == '2'
+    assert local.data_msgs.get()['1'] == msgs['1']
+
+
+def test_thread_set():
+    msgs = local.Msgs({
+        str(i): {'arrived': 10 - i, 'msgid': '<%s@mlr>' % i, 'origin_uid': i}
+        for i in range(1, 7)
+    })
+    thrids, thrs = {}, {}
+    threads = local.ThreadSet(thrids, thrs, msgs)
+    assert threads.union(['5', '6']) == '5'
+    assert threads.union(['4']) == '4'
+    assert threads.union(['4', '5']) == '4'
+    assert thrs == {'4': ['6', '5', '4']}
+    assert thrids == {'4': '4', '5': '4', '6': '5'}
+    assert dict(threads.thrids) == {'4': '4', '5': '4', '6': '4'}
+    # reads don't change saved values
+    assert thrids == {'4': '4', '5': '4', '6': '5'}
+
+    assert threads.union(['1', '2', '6']) == '1'
+    assert thrs == {'1': ['6', '5', '4', '2', '1']}
+    assert threads.remove('5') == []
+    assert thrs == {'1': ['6', '4', '2', '1']}
+    assert dict(threads.thrids) == {'1': '1', '2': '1', '4': '1', '6': '1'}
+    assert threads.remove('1') == ['6', '4', '2', '1']
+    assert thrs == {}
+    assert thrids == {}
+
+
+def test_thread_refs():
+    assert local.thread_refs([]) == []
+    assert local.thread_refs([
+        ('1', '<1@mlr>', []),
+        ('2', '<2@mlr>', ['<1@mlr>']),
+        ('3', '<3@mlr>', ['<x@mlr>']),
+        ('4', '<4@mlr>', ['<x@mlr>', '<2@mlr>']),
+        ('5', '<5@mlr>', ['<5@mlr>']),
+        ('6', '<5@mlr>', []),
+    ]) == [['1', '2', '4'], ['3'], ['5'], ['6']]
+
+
+def test_update_metadata(gm_client):
+    gm_client.add_emails([{}, {'flags': '\\Flagged'}])
+    assert sorted(local.data_msgs.get()) == ['1', '2']
+    summaries = dict(local.data_summaries.get())
+    assert sorted(summaries) == ['1', '2']
+    assert '\\Flagged' in summaries['2']['all']['flags']
+    assert '\\Flagged' not in summaries['1']['all']['flags']
+
+    local.update_metadata('1:*')
+    assert dict(local.data_summaries.get()) == summaries
+    assert local.data_threads.get()[1] == {'1': ['1'], '2': ['2']}
+
+
+def test_summaries_missing(gm_client):
+    gm_client.add_emails([{}, {'flags': '\\Flagged'}])
+    # like right after upgrade: summaries have never been built
+    local.data_summaries({})
+    local.data_modseq.unset()
+    res = list(local.thrs_info(['1', '2']))
+    assert [i[0] for i in res] == ['1', '2']
+    assert '\\Flagged' in res[1][2]
+    assert local.data_summaries.get() == {}
+
+    local.rebuild_metadata()
+    assert sorted(local.data_summaries.get()) == ['1', '2']
+    assert local.data_modseq.get()
+
+
+def test_thread_summary():
+    msgs = {
+        '1': {'from': 'a', 'draft_id': None},
+        '2': {'from': 'b', 'draft_id': '<2@mlr>'},
+        '3': {'from': 'c', 'draft_id': None},
+    }
+    flags = {'1': ['\\Seen', '#inbox'], '2': ['\\Draft'], '3': ['#trash']}
+    assert local.thread_summary(['1', '2', '3'], msgs, flags) == {
+        'all': {
+            'uid': '2', 'unread': 1, 'addrs': ['a', 'b'],
+            'flags': ['#inbox', '\\Draft', '\\Seen'], 'draft_id': '<2@mlr>'
+        },
+        '#trash': {
+            'uid': '3', 'unread': 1, 'addrs': ['c'],
+            'flags': ['#trash'], 'draft_id': None
+        },
+    }
+    assert local.thread_summary(['3'], msgs, {}) == {'all': {
+        'uid': '3', 'unread': 1, 'addrs': ['c'], 'flags': [], 'draft_id': None
+    }}
+
+
 def test_data_threads(gm_client):
     gm_client.add_emails([{'subj': 'new subj'}])
     assert local.data_threads.get()[1] == {'1': ['1']}
@@ -164,6 +496,9 @@ def test_link_threads_part1(gm_client, msgs):
     local.link_threads(['4', '5'])
     assert local.search_thrs('all') == ['5']
     assert local.data_threads.get()[1] == {'5': ['3', '4', '5']}
+    links = local.data_links.get()
+    assert len(links) == 1 and len(links[0]) == 3
+    assert local.data_linkids.get() == {mid: links[0] for mid in links[0]}
     res = msgs(local.SRC)
     assert [i['body']['references'] for i in res] == [None, None, None]
     res = msgs()